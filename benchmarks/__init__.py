@@ -0,0 +1,17 @@
+"""
+pyvfs benchmarks
+~~~~~~~~~~~~~~~~
+
+Microbenchmarks of the storage, ObjectFS and protocol layers,
+and of the import time.
+They drive ``pyvfs.vfs.Storage``, ``pyvfs.objectfs.ObjectFS``
+and the ``v9fs`` request handlers directly, with fake request
+objects, so no mount is needed::
+
+    python -m benchmarks                  # run all the cases
+    python -m benchmarks storage.read     # cases matching a prefix
+    python -m benchmarks -o base.json     # save results as JSON
+    python -m benchmarks -c base.json     # compare with saved results
+
+See ``benchmarks.runner`` for the case registration API.
+"""
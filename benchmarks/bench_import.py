@@ -0,0 +1,48 @@
+"""
+Startup: ``import pyvfs`` in a fresh interpreter
+
+Every operation is a new interpreter process, so the numbers
+include the interpreter startup; compare with ``import.python``.
+"""
+import os
+import sys
+import subprocess
+from benchmarks.runner import case
+
+RUNS = 20
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def interpreter(code):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([TOP] + [x for x in
+                                        [env.get("PYTHONPATH")] if x])
+    command = [sys.executable, "-c", code]
+
+    def run():
+        for i in range(RUNS):
+            subprocess.check_call(command, env=env)
+    return run
+
+
+@case("import.python", ops=RUNS)
+def import_python():
+    return interpreter("pass")
+
+
+@case("import.pyvfs", ops=RUNS)
+def import_pyvfs():
+    # an application, that only imports pyvfs and keeps the FS
+    # disabled
+    return interpreter("import pyvfs")
+
+
+@case("import.pyvfs.objectfs", ops=RUNS)
+def import_objectfs():
+    return interpreter("import pyvfs; pyvfs.ObjectFS")
+
+
+@case("import.pyvfs.server", ops=RUNS)
+def import_server():
+    # the protocol modules are loaded only by a Server instance
+    return interpreter("import pyvfs; pyvfs.Server")
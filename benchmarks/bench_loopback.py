@@ -0,0 +1,84 @@
+"""
+9p over the in-process loopback: client, socket and py9p server
+"""
+import os
+import tempfile
+from pyvfs.vfs import Storage
+from benchmarks.runner import case, Skip
+try:
+    from py9p import py9p
+    from pyvfs.loopback import Loopback
+except Exception:
+    py9p = None
+
+SIZE = 4 * 1048576
+MSIZE = 65536
+# Tread requests to read the file, the last one is short
+READS = SIZE // (MSIZE - 24) + 1
+
+
+def setup(window=32, address=None):
+    if py9p is None:
+        raise Skip("py9p is not available")
+    storage = Storage()
+    inode = storage.create("file", storage.root)
+    storage.write(inode, b"x" * SIZE)
+    storage.commit(inode)
+    return Loopback(storage, msize=MSIZE, window=window, address=address)
+
+
+def stat_latency(address=None):
+    loop = setup(address=address)
+    client = loop.client
+    fid = client.walk("file")
+
+    def run():
+        for i in range(5000):
+            client.stat(fid)
+        loop.close()
+    return run
+
+
+@case("loopback.stat", ops=5000)
+def stat_socketpair():
+    return stat_latency()
+
+
+@case("loopback.stat.tcp", ops=5000)
+def stat_tcp():
+    return stat_latency("127.0.0.1")
+
+
+@case("loopback.stat.unix", ops=5000)
+def stat_unix():
+    path = os.path.join(tempfile.gettempdir(), "pyvfs-bench-{pid}.sock")
+    return stat_latency("unix:" + path)
+
+
+@case("loopback.stat.abstract", ops=5000)
+def stat_abstract():
+    return stat_latency("@pyvfs-bench-{pid}")
+
+
+@case("loopback.read.sync", ops=READS * 4, size=SIZE * 4)
+def read_sync():
+    loop = setup(window=1)
+    client = loop.client
+
+    def run():
+        for i in range(4):
+            client.read_file("file")
+        loop.close()
+    return run
+
+
+@case("loopback.read.pipelined", ops=READS * 4, size=SIZE * 4)
+def read_pipelined():
+    loop = setup(window=32)
+    client = loop.client
+
+    def run():
+        for i in range(4):
+            client.read_file("file")
+        loop.close()
+    return run
@@ -0,0 +1,342 @@
+"""
+ObjectFS layer: exported Python objects
+"""
+import stat
+import threading
+from pyvfs.objectfs import ObjectFS, export as export_class
+from benchmarks.runner import case
+from benchmarks.bench_storage import CHUNK, STREAM
+
+
+class Item(object):
+
+    def __init__(self, index):
+        self.index = index
+        self.name = "item-%i" % (index)
+        self.enabled = True
+        self.ratio = index / 3.0
+
+
+class Big(object):
+
+    def __init__(self, count):
+        for i in range(count):
+            setattr(self, "attr%i" % (i), i)
+
+
+class Node(object):
+
+    def __init__(self, index):
+        self.index = index
+        self.peer = None
+        self.next = None
+
+
+def add(a, b=2):
+    return a + b
+
+
+def export(fs, obj, **config):
+    return fs.create(obj=obj, root=True, is_internal=True, **config)
+
+
+def keep(run, *objects):
+    """
+    Exported roots are tracked with weak references, so the
+    objects should live as long as the case callable
+    """
+    run.objects = objects
+    return run
+
+
+@case("objectfs.export", ops=2000)
+def export_roots():
+    fs = ObjectFS()
+    items = [Item(i) for i in range(2000)]
+
+    def run():
+        for i in items:
+            export(fs, i)
+    return run
+
+
+def exported(fs, **config):
+    @export_class(fs=fs, **config)
+    class Exported(Item):
+        pass
+    return Exported
+
+
+@case("objectfs.export.decorator", ops=5000)
+def export_decorator():
+    fs = ObjectFS()
+    klass = exported(fs)
+    items = []
+
+    def run():
+        for i in range(5000):
+            items.append(klass(i))
+    return keep(run, items)
+
+
+@case("objectfs.export.short", ops=5000)
+def export_short():
+    # short-lived instances, only one of 100 survives
+    fs = ObjectFS()
+    klass = exported(fs)
+    items = []
+
+    def run():
+        for i in range(5000):
+            item = klass(i)
+            if i % 100 == 0:
+                items.append(item)
+    return keep(run, items)
+
+
+@case("objectfs.export.deferred", ops=5000)
+def export_deferred():
+    fs = ObjectFS()
+    fs.export_delay = 3600
+    klass = exported(fs, deferred=True)
+    items = []
+
+    def run():
+        for i in range(5000):
+            items.append(klass(i))
+    return keep(run, items)
+
+
+@case("objectfs.export.deferred.short", ops=5000)
+def export_deferred_short():
+    # the queue is flushed with the root listing: collected
+    # instances should be skipped
+    fs = ObjectFS()
+    fs.export_delay = 3600
+    klass = exported(fs, deferred=True)
+    items = []
+
+    def run():
+        for i in range(5000):
+            item = klass(i)
+            if i % 100 == 0:
+                items.append(item)
+        del item
+        fs.sync(fs.root)
+        assert fs.export_counters["exported"] == len(items)
+    return keep(run, items)
+
+
+@case("objectfs.export.flush", ops=5000)
+def export_flush():
+    fs = ObjectFS()
+    fs.export_delay = 3600
+    klass = exported(fs, deferred=True)
+    items = [klass(i) for i in range(5000)]
+
+    def run():
+        fs.flush_exports()
+        assert fs.export_counters["exported"] == len(items)
+    return keep(run, items)
+
+
+@case("objectfs.sync.roots", ops=2000 * 20)
+def sync_roots():
+    fs = ObjectFS()
+    items = [Item(i) for i in range(2000)]
+    for i in items:
+        export(fs, i)
+
+    def run():
+        for i in range(20):
+            fs.sync(fs.root)
+    return keep(run, items)
+
+
+@case("objectfs.reap", ops=2000)
+def reap():
+    # exported objects die, the root listing should drop them
+    fs = ObjectFS()
+    items = [Item(i) for i in range(2000)]
+    for i in items:
+        export(fs, i)
+
+    def run():
+        del items[:]
+        fs.sync(fs.root)
+        assert len(fs.exports) == 0
+    return run
+
+
+@case("objectfs.sync.large", ops=5000)
+def sync_large():
+    fs = ObjectFS()
+    big = Big(5000)
+    root = export(fs, big)
+
+    def run():
+        fs.sync(root)
+    return keep(run, big)
+
+
+@case("objectfs.sync.steady", ops=5000 * 20)
+def sync_steady():
+    fs = ObjectFS()
+    big = Big(5000)
+    root = export(fs, big)
+    fs.sync(root)
+
+    def run():
+        for i in range(20):
+            fs.sync(root)
+    return keep(run, big)
+
+
+@case("objectfs.read.attr", ops=20000)
+def read_attr():
+    fs = ObjectFS()
+    item = Item(1)
+    root = export(fs, item)
+    fs.sync(root)
+    inode = root.children["name"]
+
+    def run():
+        for i in range(20000):
+            fs.read(inode, 4096, 0)
+    return keep(run, item)
+
+
+@case("objectfs.read.all", ops=5000)
+def read_all():
+    # read every attribute file, as a scraper without .json would
+    fs = ObjectFS()
+    big = Big(5000)
+    root = export(fs, big)
+
+    def run():
+        fs.sync(root)
+        for (name, inode) in list(root.children.items()):
+            if name not in root.special_names and \
+                    name not in root.auto_names:
+                fs.read(inode, 4096, 0)
+    return keep(run, big)
+
+
+@case("objectfs.dump.json", ops=5000)
+def dump_json():
+    fs = ObjectFS()
+    big = Big(5000)
+    root = export(fs, big)
+    inode = root.children[".json"]
+
+    def run():
+        offset = 0
+        while True:
+            data = fs.read(inode, 65536, offset)
+            if not data:
+                break
+            offset += len(data)
+    return keep(run, big)
+
+
+@case("objectfs.watch.notify", ops=1000)
+def watch_notify():
+    # notify() to .watch read wakeup round trips
+    fs = ObjectFS()
+    item = Item(1)
+    root = export(fs, item)
+    watch = root.children[".watch"]
+    watch.pending()
+
+    def run():
+        done = threading.Event()
+
+        def reader():
+            for i in range(1000):
+                fs.read(watch, 4096, 0)
+                done.set()
+
+        thread = threading.Thread(target=reader)
+        thread.start()
+        for i in range(1000):
+            fs.notify(item, "name")
+            done.wait()
+            done.clear()
+        thread.join()
+    return keep(run, item)
+
+
+@case("objectfs.write.stream", ops=STREAM // CHUNK, size=STREAM)
+def write_stream():
+    # truncate, write and commit a string attribute: the value
+    # should be cast once, on the final commit
+    fs = ObjectFS()
+    item = Item(1)
+    root = export(fs, item)
+    fs.sync(root)
+    inode = root.children["name"]
+    data = b"x" * CHUNK
+
+    def run():
+        fs.truncate(inode)
+        for offset in range(0, STREAM, CHUNK):
+            fs.write(inode, data, offset)
+        fs.commit(inode)
+        assert len(item.name) == STREAM
+    return keep(run, item)
+
+
+@case("objectfs.cycle", ops=500)
+def cycle():
+    # a ring of nodes, every node also refers to the opposite one,
+    # so the export is full of back references
+    fs = ObjectFS()
+    nodes = [Node(i) for i in range(500)]
+    for (i, node) in enumerate(nodes):
+        node.next = nodes[(i + 1) % len(nodes)]
+        node.peer = nodes[(i + len(nodes) // 2) % len(nodes)]
+    root = export(fs, nodes[0])
+
+    def run():
+        queue = [root]
+        while queue:
+            inode = queue.pop()
+            fs.sync(inode)
+            queue.extend([x for (name, x) in inode.children.items()
+                          if name not in inode.special_names and
+                          x.mode & stat.S_IFDIR])
+    return keep(run, nodes)
+
+
+@case("objectfs.call", ops=5000)
+def call():
+    fs = ObjectFS()
+    root = export(fs, add, export_functions=True)
+    inode = root.children["call"]
+
+    def run():
+        for i in range(5000):
+            fs.open(inode)
+            fs.truncate(inode)
+            fs.write(inode, b"a = 1\nb = 2\n")
+            fs.commit(inode)
+            fs.read(inode, 4096, 0)
+    return run
+
+
+@case("objectfs.context", ops=2000)
+def context():
+    fs = ObjectFS()
+    root = export(fs, add, export_functions=True)
+    ctx = root.children["context"]
+
+    def run():
+        for i in range(2000):
+            fs.open(ctx)
+            name = fs.read(ctx, 4096, 0).decode("utf-8")
+            inode = root.children[name]
+            fs.write(inode, b"a = 1\n")
+            fs.commit(inode)
+            fs.read(inode, 4096, 0)
+            fs.remove(inode)
+    return run
@@ -0,0 +1,279 @@
+"""
+Storage layer: pyvfs.vfs.Storage and plain inodes
+"""
+import os
+import stat
+import time
+import random
+import tempfile
+import threading
+from pyvfs.vfs import Storage, MappedInode
+from benchmarks.runner import case
+
+SMALL = 128
+CHUNK = 65536
+LARGE = 16 * 1048576
+STREAM = 100 * 1048576
+READERS = 4
+
+
+def tree(storage, parent, fanout, depth):
+    """
+    Create a ``fanout``-ary directory tree of ``depth`` levels,
+    with ``fanout`` files in every leaf directory. Return the
+    number of inodes created.
+    """
+    count = 0
+    for i in range(fanout):
+        if depth > 1:
+            new = storage.create("d%i" % (i), parent, stat.S_IFDIR)
+            count += 1 + tree(storage, new, fanout, depth - 1)
+        else:
+            storage.create("f%i" % (i), parent)
+            count += 1
+    return count
+
+
+@case("storage.create", ops=10000)
+def create():
+    storage = Storage()
+    parent = storage.create("dir", storage.root, stat.S_IFDIR)
+
+    def run():
+        for i in range(10000):
+            storage.create("f%i" % (i), parent)
+    return run
+
+
+@case("storage.walk.deep", ops=64 * 500)
+def walk_deep():
+    storage = Storage()
+    parent = storage.root
+    names = []
+    for i in range(64):
+        names.append("d%i" % (i))
+        parent = storage.create(names[-1], parent, stat.S_IFDIR)
+
+    def run():
+        for i in range(500):
+            inode = storage.root
+            for name in names:
+                storage.sync(inode)
+                inode = inode.children[name]
+    return run
+
+
+@case("storage.walk.wide", ops=20000)
+def walk_wide():
+    storage = Storage()
+    parent = storage.create("dir", storage.root, stat.S_IFDIR)
+    paths = [storage.create("f%i" % (i), parent).path
+             for i in range(10000)]
+
+    def run():
+        for i in range(20000):
+            inode = storage.checkout(paths[(i * 7919) % len(paths)])
+            storage.sync(inode)
+    return run
+
+
+@case("storage.listdir", ops=1000 * 20)
+def listdir():
+    storage = Storage()
+    parent = storage.create("dir", storage.root, stat.S_IFDIR)
+    for i in range(1000):
+        storage.create("f%i" % (i), parent)
+
+    def run():
+        for i in range(20):
+            storage.sync(parent)
+            for (name, inode) in list(parent.children.items()):
+                if name not in parent.special_names:
+                    storage.sync(inode)
+    return run
+
+
+@case("storage.read.small", ops=50000, size=50000 * SMALL)
+def read_small():
+    storage = Storage()
+    inode = storage.create("file", storage.root)
+    storage.write(inode, b"x" * SMALL)
+    storage.commit(inode)
+
+    def run():
+        for i in range(50000):
+            storage.read(inode, SMALL, 0)
+    return run
+
+
+@case("storage.read.large", ops=LARGE // CHUNK * 4, size=LARGE * 4)
+def read_large():
+    storage = Storage()
+    inode = storage.create("file", storage.root)
+    storage.write(inode, b"x" * LARGE)
+    storage.commit(inode)
+
+    def run():
+        for i in range(4):
+            for offset in range(0, LARGE, CHUNK):
+                storage.read(inode, CHUNK, offset)
+    return run
+
+
+@case("storage.read.mapped", ops=LARGE // CHUNK * 4, size=LARGE * 4)
+def read_mapped():
+    # the same as storage.read.large, but the data is in a
+    # mapped file, not on the heap
+    storage = Storage()
+    (fd, path) = tempfile.mkstemp(prefix="pyvfs-bench-")
+    try:
+        os.write(fd, b"x" * LARGE)
+        os.close(fd)
+        inode = MappedInode("file", storage.root, source=path)
+    finally:
+        os.unlink(path)
+
+    def run():
+        for i in range(4):
+            for offset in range(0, LARGE, CHUNK):
+                storage.read(inode, CHUNK, offset)
+    return run
+
+
+@case("storage.read.parallel", ops=READERS * 16 * (LARGE // CHUNK - 1),
+      size=READERS * 16 * (LARGE - CHUNK))
+def read_parallel():
+    # parallel readers of a large file, past the first chunk,
+    # while another thread runs slow syncs of another inode
+    storage = Storage()
+    inode = storage.create("file", storage.root)
+    storage.write(inode, b"x" * LARGE)
+    storage.commit(inode)
+    slow = storage.create("slow", storage.root)
+    slow.on_sync = lambda x: time.sleep(0.01) or True
+
+    def syncer(stop):
+        while not stop.is_set():
+            storage.sync(slow)
+
+    def reader():
+        for i in range(16):
+            for offset in range(CHUNK, LARGE, CHUNK):
+                storage.read(inode, CHUNK, offset)
+
+    def run():
+        stop = threading.Event()
+        background = threading.Thread(target=syncer, args=(stop,))
+        background.start()
+        readers = [threading.Thread(target=reader) for i in range(READERS)]
+        for thread in readers:
+            thread.start()
+        for thread in readers:
+            thread.join()
+        stop.set()
+        background.join()
+    return run
+
+
+@case("storage.write.small", ops=50000, size=50000 * SMALL)
+def write_small():
+    storage = Storage()
+    inode = storage.create("file", storage.root)
+    data = b"x" * SMALL
+
+    def run():
+        for i in range(50000):
+            storage.write(inode, data, 0)
+            storage.commit(inode)
+    return run
+
+
+@case("storage.write.large", ops=LARGE // CHUNK * 4, size=LARGE * 4)
+def write_large():
+    storage = Storage()
+    inode = storage.create("file", storage.root)
+    data = b"x" * CHUNK
+
+    def run():
+        for i in range(4):
+            storage.truncate(inode)
+            for offset in range(0, LARGE, CHUNK):
+                storage.write(inode, data, offset)
+            storage.commit(inode)
+    return run
+
+
+@case("storage.write.stream", ops=STREAM // CHUNK, size=STREAM)
+def write_stream():
+    storage = Storage()
+    inode = storage.create("file", storage.root)
+    data = b"x" * CHUNK
+
+    def run():
+        storage.truncate(inode)
+        for offset in range(0, STREAM, CHUNK):
+            storage.write(inode, data, offset)
+        storage.commit(inode)
+    return run
+
+
+@case("storage.write.shuffled", ops=STREAM // CHUNK, size=STREAM)
+def write_shuffled():
+    storage = Storage()
+    inode = storage.create("file", storage.root)
+    data = b"x" * CHUNK
+    offsets = list(range(0, STREAM, CHUNK))
+    random.Random(1).shuffle(offsets)
+
+    def run():
+        storage.truncate(inode)
+        for offset in offsets:
+            storage.write(inode, data, offset)
+        storage.commit(inode)
+    return run
+
+
+@case("storage.rename.subtree", ops=10)
+def rename_subtree():
+    storage = Storage()
+    top = storage.create("top", storage.root, stat.S_IFDIR)
+    tree(storage, top, 20, 3)
+
+    def run():
+        for i in range(10):
+            storage.reparent(storage.root, top, "top%i" % (i))
+    return run
+
+
+@case("storage.teardown", ops=8421)
+def teardown():
+    storage = Storage()
+    top = storage.create("top", storage.root, stat.S_IFDIR)
+    tree(storage, top, 20, 3)
+
+    def run():
+        storage.remove(top)
+    return run
+
+
+@case("storage.sync.stats", ops=100000)
+def sync_stats():
+    storage = Storage()
+    inode = storage.create("file", storage.root)
+
+    def run():
+        for i in range(100000):
+            storage.sync(inode)
+    return run
+
+
+@case("storage.sync.nostats", ops=100000)
+def sync_nostats():
+    storage = Storage()
+    storage.stats = None
+    inode = storage.create("file", storage.root)
+
+    def run():
+        for i in range(100000):
+            storage.sync(inode)
+    return run
@@ -0,0 +1,147 @@
+"""
+9p layer: v9fs request handlers, called with fake requests
+"""
+import stat
+from pyvfs.vfs import Storage
+from benchmarks.runner import case, Skip
+from benchmarks.bench_storage import SMALL
+try:
+    from py9p import py9p
+    from pyvfs.v9fs import v9fs
+except Exception:
+    py9p = None
+
+
+class Fake(object):
+    """
+    A plain object with the given attributes, stands for
+    py9p requests and their ``fid``, ``ifcall`` and ``ofcall``
+    """
+    def __init__(self, **kwarg):
+        self.__dict__.update(kwarg)
+
+
+class FakeServer(object):
+    """
+    Stands for py9p.Server, only counts responses
+    """
+    def __init__(self):
+        self.responses = 0
+        self.errors = 0
+
+    def respond(self, req, error):
+        self.responses += 1
+        if error is not None:
+            self.errors += 1
+
+
+def request(inode, **ifcall):
+    return Fake(fid=Fake(qid=Fake(path=inode.path)),
+                ifcall=Fake(**ifcall),
+                ofcall=Fake(wqid=[], stat=[]))
+
+
+def setup():
+    if py9p is None:
+        raise Skip("py9p is not available")
+    storage = Storage()
+    return (storage, v9fs(storage), FakeServer())
+
+
+@case("v9fs.walk.deep", ops=500)
+def walk_deep():
+    (storage, fs, srv) = setup()
+    parent = storage.root
+    names = []
+    for i in range(64):
+        names.append("d%i" % (i))
+        parent = storage.create(names[-1], parent, stat.S_IFDIR)
+
+    def run():
+        for i in range(500):
+            fs.walk(srv, request(storage.root, wname=list(names)))
+        assert srv.errors == 0
+    return run
+
+
+@case("v9fs.walk.wide", ops=2000)
+def walk_wide():
+    (storage, fs, srv) = setup()
+    parent = storage.create("dir", storage.root, stat.S_IFDIR)
+    names = ["f%i" % (i) for i in range(10000)]
+    for name in names:
+        storage.create(name, parent)
+
+    def run():
+        for i in range(2000):
+            name = names[(i * 7919) % len(names)]
+            fs.walk(srv, request(parent, wname=[name]))
+        assert srv.errors == 0
+    return run
+
+
+@case("v9fs.read.dir", ops=1000 * 20)
+def read_dir():
+    (storage, fs, srv) = setup()
+    parent = storage.create("dir", storage.root, stat.S_IFDIR)
+    for i in range(1000):
+        storage.create("f%i" % (i), parent)
+
+    def run():
+        for i in range(20):
+            fs.read(srv, request(parent, offset=0, count=8192))
+        assert srv.errors == 0
+    return run
+
+
+@case("v9fs.stat", ops=20000)
+def stat_file():
+    (storage, fs, srv) = setup()
+    inode = storage.create("file", storage.root)
+
+    def run():
+        for i in range(20000):
+            fs.stat(srv, request(inode))
+        assert srv.errors == 0
+    return run
+
+
+@case("v9fs.create", ops=5000)
+def create():
+    (storage, fs, srv) = setup()
+    parent = storage.create("dir", storage.root, stat.S_IFDIR)
+
+    def run():
+        for i in range(5000):
+            fs.create(srv, request(parent, name="f%i" % (i),
+                                   perm=0o644, extension=""))
+        assert srv.errors == 0
+    return run
+
+
+@case("v9fs.read.small", ops=20000, size=20000 * SMALL)
+def read_small():
+    (storage, fs, srv) = setup()
+    inode = storage.create("file", storage.root)
+    storage.write(inode, b"x" * SMALL)
+    storage.commit(inode)
+
+    def run():
+        for i in range(20000):
+            fs.read(srv, request(inode, offset=0, count=SMALL))
+        assert srv.errors == 0
+    return run
+
+
+@case("v9fs.write.small", ops=20000, size=20000 * SMALL)
+def write_small():
+    (storage, fs, srv) = setup()
+    inode = storage.create("file", storage.root)
+    data = b"x" * SMALL
+
+    def run():
+        for i in range(20000):
+            fs.write(srv, request(inode, offset=0, data=data))
+            fs.clunk(srv, request(inode))
+        assert srv.errors == 0
+    return run
@@ -0,0 +1,157 @@
+"""
+benchmarks.runner -- case registry and runner
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+A case is a setup function, registered with the ``case``
+decorator. The setup builds the fixture and returns a callable,
+that runs ``ops`` operations; only the callable is timed::
+
+    @case("storage.sync", ops=10000)
+    def sync():
+        storage = Storage()
+        inode = Inode("file", storage.root)
+
+        def run():
+            for i in range(10000):
+                storage.sync(inode)
+        return run
+
+The setup may raise ``Skip``, if the case can not run, e.g.
+because of a missing dependency.
+
+Every case runs ``repeat`` times with a fresh fixture, the best
+time is reported as ops/sec. Then it runs once more under
+``tracemalloc`` (if available) to get the peak memory of the
+callable run.
+"""
+import gc
+import sys
+import json
+import time
+import argparse
+import platform
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    _clock = time.time
+
+
+modules = ("storage", "objectfs", "v9fs", "loopback", "import")
+cases = []
+
+
+class Skip(Exception):
+    pass
+
+
+def case(name, ops, size=None):
+    """
+    Register a benchmark case. ``ops`` is the number of operations
+    the returned callable runs, ``size`` -- optional number of
+    bytes it processes, to report the throughput.
+    """
+    def decorator(setup):
+        cases.append((name, ops, size, setup))
+        return setup
+    return decorator
+
+
+def measure(name, ops, size, setup, repeat=3, memory=True):
+    result = {"name": name,
+              "ops": ops}
+    times = []
+    try:
+        for i in range(repeat):
+            run = setup()
+            gc.collect()
+            start = _clock()
+            run()
+            times.append(_clock() - start)
+            del run
+    except Skip as e:
+        result["skipped"] = str(e)
+        return result
+    times.sort()
+    result["best"] = times[0]
+    result["median"] = times[len(times) // 2]
+    result["ops_per_sec"] = ops / times[0]
+    if size is not None:
+        result["mb_per_sec"] = size / times[0] / 1048576
+    result["peak_bytes"] = None
+    if memory and tracemalloc is not None:
+        run = setup()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run()
+            result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def load():
+    for module in modules:
+        __import__("benchmarks.bench_%s" % (module))
+
+
+def report(results, base=None):
+    base = dict([(x["name"], x) for x in (base or [])])
+    for x in results:
+        if "skipped" in x:
+            sys.stdout.write("%-32s skipped: %s\n" % (x["name"],
+                                                      x["skipped"]))
+            continue
+        line = "%-32s %14.1f ops/s" % (x["name"], x["ops_per_sec"])
+        if "mb_per_sec" in x:
+            line += " %9.1f MB/s" % (x["mb_per_sec"])
+        if x["peak_bytes"] is not None:
+            line += " %10.1f KiB peak" % (x["peak_bytes"] / 1024.0)
+        old = base.get(x["name"])
+        if old and old.get("ops_per_sec"):
+            line += "  x%.2f" % (x["ops_per_sec"] / old["ops_per_sec"])
+        sys.stdout.write(line + "\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="pyvfs benchmarks")
+    parser.add_argument("prefix", nargs="*",
+                        help="run only cases with these name prefixes")
+    parser.add_argument("-o", "--output",
+                        help="write results to this JSON file")
+    parser.add_argument("-c", "--compare",
+                        help="compare with results from this JSON file")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="runs per case, the best is reported")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="do not measure peak memory")
+    args = parser.parse_args(argv)
+
+    load()
+    results = []
+    for (name, ops, size, setup) in cases:
+        if args.prefix and not [x for x in args.prefix
+                                if name.startswith(x)]:
+            continue
+        results.append(measure(name, ops, size, setup, args.repeat,
+                               not args.no_memory))
+        report(results[-1:])
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            base = json.load(f)["results"]
+        sys.stdout.write("\n")
+        report(results, base)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "implementation": platform.python_implementation(),
+                       "platform": platform.platform(),
+                       "time": int(time.time()),
+                       "results": results}, f, indent=4, sort_keys=True)
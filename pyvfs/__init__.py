@@ -2,7 +2,6 @@
 #
 import sys
 import logging
-from abc import ABCMeta
 
 log = logging.getLogger(__name__)
 # Add a NullHandler to the library's top-level logger to avoid complaints
@@ -18,8 +17,22 @@ _modules = {'export': 'pyvfs.objectfs',
             'Server': 'pyvfs.server'}
 
 
-for name in _modules:
+def _load(name):
     module = __import__(_modules[name], globals(), locals(), [name], 0)
-    obj = getattr(module, name)
-    globals()[name] = obj
+    obj = globals()[name] = getattr(module, name)
+    return obj
+
+
+def __getattr__(name):
+    # PEP 562: ObjectFS and Server are imported on the first use,
+    # so an application pays for them only if the FS is enabled
+    if name in _modules:
+        return _load(name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+for name in _modules:
     __all__.append(name)
+    # no module __getattr__ before Python 3.7
+    if sys.version_info < (3, 7):
+        _load(name)
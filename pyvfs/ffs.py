@@ -4,9 +4,11 @@ pyvfs.ffs -- FUSE connector
 
 The abstraction layer for the FUSE
 """
+import os
 import fuse
 import errno
 import stat
+from pyvfs.vfs import timed
 
 
 class fStat(fuse.Stat):
@@ -59,19 +61,48 @@ fuse.fuse_python_api = (0, 2)
 class ffs(fuse.Fuse, object):
     """
     FUSE abstraction layer
+
+    Handlers may run in parallel threads, see PYVFS_MULTITHREADED.
+    The storage serializes changes, while ``getattr`` of static
+    inodes, ``readdir`` and reads past the first chunk do not
+    take the storage lock. ``getattr`` and reads at offset 0 of
+    dynamic inodes, like ObjectFS attributes, sync the inode
+    under the storage lock, so those are still serialized:
+    sync hooks and change recording rely on it.
+
+    ``open()`` tells the kernel how to cache the file data, by
+    the inode ``cache`` policy: ``keep_cache`` for static inodes,
+    since their data changes only with writes, and ``direct_io``
+    for inodes, that generate the data on sync, so every read
+    gets the current data, whatever the size in the last
+    ``getattr``. Set ``keep_cache`` or ``direct_io`` attributes
+    to False to disable them.
+
+    Truncates are committed with the last ``release()`` of the
+    file, like writes, so an ``O_TRUNC`` open followed by writes
+    is committed once; a path ``truncate()`` of a file, that is
+    not open, is committed at once. The server mounts with
+    ``atomic_o_trunc``, so ``O_TRUNC`` comes with ``open()``.
     """
+    keep_cache = True
+    direct_io = True
 
     def __init__(self, storage, *argv, **kwarg):
         fuse.Fuse.__init__(self, *argv, **kwarg)
         self.mountpoint = '/'
         self.storage = storage
+        self.stats = storage.stats
         self.root = self.storage.root
+        # inode.path -> number of open handles
+        self.handles = {}
 
+    @timed("fuse.symlink")
     def symlink(self, path, dest):
         self.mknod(path, stat.S_IFLNK, 0)
         inode = self.storage.checkout(hash8(path))
         inode.write(dest)
 
+    @timed("fuse.mknod")
     def mknod(self, path, mode, dev):
         # work only with regular files
         if dev:
@@ -83,51 +114,103 @@ class ffs(fuse.Fuse, object):
         f = self.storage.checkout(hash8(parent))
         self.storage.create(fname, f, mode)
 
+    @timed("fuse.mkdir")
     def mkdir(self, path, mode):
         return self.mknod(path, mode, None)
 
+    @timed("fuse.readlink")
     @checkout
     def readlink(self, inode):
-        return inode.getvalue()
+        return inode.readlink()
 
+    @timed("fuse.flush")
     @checkout
     def flush(self, inode):
         self.storage.commit(inode)
 
+    @timed("fuse.chmod")
     @checkout
     def chmod(self, inode, mode):
         self.storage.chmod(inode, mode)
 
+    @timed("fuse.chown")
     @checkout
     def chown(self, inode, uid, gid):
         self.storage.chown(inode, uid, gid)
 
+    @timed("fuse.open")
     @checkout
     def open(self, inode, flags):
-        self.storage.open(inode)
-
+        with self.storage.lock:
+            self.handles[inode.path] = self.handles.get(inode.path, 0) + 1
+        try:
+            if flags & os.O_TRUNC:
+                self.storage.truncate(inode)
+            self.storage.open(inode)
+        except:
+            # there will be no release() for the failed open
+            self.drop(inode)
+            raise
+        cache = inode.cache or ("keep" if inode.static else "direct")
+        # the C side reads ``keep_cache``, FuseFileInfo's own
+        # ``keep`` attribute is ignored
+        return fuse.FuseFileInfo(keep_cache=self.keep_cache and
+                                 cache == "keep",
+                                 direct_io=self.direct_io and
+                                 cache == "direct")
+
+    @timed("fuse.getattr")
     @checkout
     def getattr(self, inode):
         self.storage.sync(inode)
         return fStat(inode)
 
+    @timed("fuse.read")
     @checkout
     def read(self, inode, size, offset):
-        return self.storage.read(inode, size, offset)
+        data = self.storage.read(inode, size, offset)
+        # MappedInode data: copy only the requested chunk
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return data
 
+    @timed("fuse.write")
     @checkout
     def write(self, inode, buf, offset):
         return self.storage.write(inode, buf, offset)
 
+    @timed("fuse.truncate")
     @checkout
     def truncate(self, inode, size):
-        self.storage.truncate(inode, size)
+        with self.storage.lock:
+            self.storage.truncate(inode, size)
+            if not self.handles.get(inode.path):
+                self.storage.commit(inode)
 
+    @timed("fuse.release")
+    @checkout
+    def release(self, inode, flags):
+        self.drop(inode)
+
+    def drop(self, inode):
+        """
+        Forget an open handle, commit the inode with the last one
+        """
+        with self.storage.lock:
+            count = self.handles.get(inode.path, 0) - 1
+            if count > 0:
+                self.handles[inode.path] = count
+            else:
+                self.handles.pop(inode.path, None)
+                self.storage.commit(inode)
+
+    @timed("fuse.utime")
     @checkout
     def utime(self, inode, times):
         inode.atime = times[0]
         inode.mtime = times[1]
 
+    @timed("fuse.unlink")
     @checkout
     def unlink(self, inode):
         try:
@@ -135,10 +218,12 @@ class ffs(fuse.Fuse, object):
         except:
             return -errno.EPERM
 
+    @timed("fuse.rmdir")
     @checkout
     def rmdir(self, inode):
         return self.unlink(inode.absolute_path())
 
+    @timed("fuse.rename")
     @checkout
     def rename(self, inode, path):
         fname, parent = getParts(path)
@@ -151,7 +236,8 @@ class ffs(fuse.Fuse, object):
     def readdir(self, path, offset):
         try:
             f = self.storage.checkout(hash8(path))
-            for i in f.children:
+            # other threads may change the directory meanwhile
+            for i in list(f.children):
                 yield fuse.Direntry(i)
 
         except:
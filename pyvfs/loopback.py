@@ -0,0 +1,525 @@
+"""
+pyvfs.loopback -- in-process 9p client
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+A pure Python 9P2000.u client and a socketpair transport,
+that runs the pyvfs 9p server in a thread of the same process.
+So the 9p path can be tested and benchmarked without a kernel
+mount and without privileges::
+
+    from pyvfs.vfs import Storage
+    from pyvfs.loopback import Loopback
+
+    storage = Storage()
+    with Loopback(storage) as client:
+        client.write_file("file", b"data")
+        print(client.read_file("file"))
+
+The client supports pipelining: ``Client.pipeline()`` sends
+a batch of requests with different tags without waiting for
+the replies, keeping up to ``window`` of them in flight.
+"""
+import os
+import socket
+import struct
+import threading
+from collections import deque, namedtuple
+
+# message types
+Tversion = 100
+Tauth = 102
+Tattach = 104
+Rerror = 107
+Tflush = 108
+Twalk = 110
+Topen = 112
+Tcreate = 114
+Tread = 116
+Twrite = 118
+Tclunk = 120
+Tremove = 122
+Tstat = 124
+Twstat = 126
+
+NOTAG = 0xffff
+NOFID = 0xffffffff
+
+# open modes
+OREAD = 0
+OWRITE = 1
+ORDWR = 2
+OTRUNC = 0x10
+
+# mode bits
+DMDIR = 0x80000000
+DMSYMLINK = 0x02000000
+
+# size[4] type[1] tag[2]
+HEADER = struct.Struct("<IBH")
+# Tread/Twrite header size, as in Plan 9
+IOHDRSZ = 24
+
+Qid = namedtuple("Qid", ("type", "version", "path"))
+Dir = namedtuple("Dir", ("type", "dev", "qid", "mode", "atime", "mtime",
+                         "length", "name", "uid", "gid", "muid",
+                         "extension", "uidnum", "gidnum", "muidnum"))
+
+_qid = struct.Struct("<BIQ")
+_stat = struct.Struct("<HIBIQIIIQ")
+_stat_u = struct.Struct("<III")
+_u16 = struct.Struct("<H")
+_u32 = struct.Struct("<I")
+
+
+class Error(Exception):
+    """
+    Rerror reply: ``ename`` and ``errno``
+    """
+    def __init__(self, ename, errno=0):
+        Exception.__init__(self, ename)
+        self.ename = ename
+        self.errno = errno
+
+
+def _enc_s(text):
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return _u16.pack(len(text)) + text
+
+
+def _dec_s(data, offset):
+    (size,) = _u16.unpack_from(data, offset)
+    offset += 2
+    return (data[offset:offset + size].decode('utf-8'), offset + size)
+
+
+def _dec_qid(data, offset=0):
+    return Qid(*_qid.unpack_from(data, offset))
+
+
+def _enc_stat(d):
+    body = _stat.pack(d.type, d.dev, d.qid.type, d.qid.version,
+                      d.qid.path, d.mode, d.atime, d.mtime, d.length) + \
+        _enc_s(d.name) + _enc_s(d.uid) + _enc_s(d.gid) + \
+        _enc_s(d.muid) + _enc_s(d.extension) + \
+        _stat_u.pack(d.uidnum, d.gidnum, d.muidnum)
+    return _u16.pack(len(body)) + body
+
+
+def _dec_stat(data, offset=0):
+    """
+    Decode one stat entry, return (Dir, next offset)
+    """
+    (size,) = _u16.unpack_from(data, offset)
+    end = offset + 2 + size
+    fields = _stat.unpack_from(data, offset + 2)
+    offset += 2 + _stat.size
+    strings = []
+    for i in range(5):
+        (text, offset) = _dec_s(data, offset)
+        strings.append(text)
+    numbers = _stat_u.unpack_from(data, offset)
+    return (Dir(fields[0], fields[1], Qid(*fields[2:5]),
+                fields[5], fields[6], fields[7], fields[8],
+                *(strings + list(numbers))), end)
+
+
+def blank_stat():
+    """
+    Twstat entry, that changes nothing: fill in only the
+    fields to change with ``_replace()``
+    """
+    return Dir(0xffff, 0xffffffff, Qid(0xff, 0xffffffff,
+                                       0xffffffffffffffff),
+               0xffffffff, 0xffffffff, 0xffffffff, 0xffffffffffffffff,
+               "", "", "", "", "", 0xffffffff, 0xffffffff, 0xffffffff)
+
+
+class Client(object):
+    """
+    9P2000.u client over a connected stream socket.
+
+    Every request has a ``_t<name>()`` method, that returns the
+    message type and body, and a ``_r<name>()`` one, that decodes
+    the reply body. Plain methods like ``walk()`` or ``read()``
+    run one request and wait for the reply; ``pipeline()`` runs
+    a batch of them.
+    """
+    def __init__(self, sock, msize=8192, uname="nobody", window=32):
+        self.sock = sock
+        self.msize = msize
+        self.uname = uname
+        self.window = window
+        self.buf = b""
+        self.tag = 0
+        self.replies = {}
+        self.fids = 0
+        self.root = None
+        self.version()
+
+    # 8<-----------------------------------------------------------------
+    #
+    # transport
+    #
+    def _next_tag(self):
+        while True:
+            self.tag = (self.tag + 1) % NOTAG
+            if self.tag not in self.replies:
+                return self.tag
+
+    def send(self, mtype, body, tag=None):
+        """
+        Send a message, return its tag
+        """
+        if tag is None:
+            tag = self._next_tag()
+        self.replies[tag] = None
+        self.sock.sendall(HEADER.pack(HEADER.size + len(body),
+                                      mtype, tag) + body)
+        return tag
+
+    def _read_message(self):
+        while True:
+            if len(self.buf) >= HEADER.size:
+                (size, mtype, tag) = HEADER.unpack_from(self.buf)
+                if len(self.buf) >= size:
+                    body = self.buf[HEADER.size:size]
+                    self.buf = self.buf[size:]
+                    return (mtype, tag, body)
+            data = self.sock.recv(max(self.msize, 65536))
+            if not data:
+                raise EOFError("9p connection closed")
+            self.buf += data
+
+    def recv(self, tag):
+        """
+        Wait for the reply with ``tag``, return (type, body). Replies
+        to other tags, that arrive meanwhile, are kept.
+        """
+        while self.replies.get(tag) is None:
+            (mtype, rtag, body) = self._read_message()
+            if rtag in self.replies:
+                self.replies[rtag] = (mtype, body)
+        return self.replies.pop(tag)
+
+    def _decode(self, name, reply):
+        (mtype, body) = reply
+        if mtype == Rerror:
+            (ename, offset) = _dec_s(body, 0)
+            errno = 0
+            if len(body) >= offset + 4:
+                (errno,) = _u32.unpack_from(body, offset)
+            return Error(ename, errno)
+        return getattr(self, "_r%s" % (name))(body)
+
+    def pipeline(self, requests):
+        """
+        Run requests like ``("read", fid, offset, count)`` without
+        waiting for every reply before sending the next request.
+        Return the list of results; failed requests give ``Error``
+        instances instead of raising.
+        """
+        results = [None] * len(requests)
+        inflight = deque()
+        for (index, request) in enumerate(requests):
+            if len(inflight) >= self.window:
+                (i, name, tag) = inflight.popleft()
+                results[i] = self._decode(name, self.recv(tag))
+            (mtype, body) = getattr(self, "_t%s" % (request[0]))(
+                *request[1:])
+            inflight.append((index, request[0], self.send(mtype, body)))
+        while inflight:
+            (i, name, tag) = inflight.popleft()
+            results[i] = self._decode(name, self.recv(tag))
+        return results
+
+    def call(self, name, *argv):
+        """
+        Run one request and return the decoded reply, raise
+        ``Error`` on Rerror
+        """
+        (mtype, body) = getattr(self, "_t%s" % (name))(*argv)
+        result = self._decode(name, self.recv(self.send(mtype, body)))
+        if isinstance(result, Error):
+            raise result
+        return result
+
+    def new_fid(self):
+        self.fids += 1
+        return self.fids
+
+    # 8<-----------------------------------------------------------------
+    #
+    # messages
+    #
+    def _tversion(self, msize, version):
+        return (Tversion, _u32.pack(msize) + _enc_s(version))
+
+    def _rversion(self, body):
+        (msize,) = _u32.unpack_from(body)
+        return (msize, _dec_s(body, 4)[0])
+
+    def _tattach(self, fid, afid, uname, aname):
+        return (Tattach, struct.pack("<II", fid, afid) + _enc_s(uname) +
+                _enc_s(aname) + _u32.pack(NOFID))
+
+    def _rattach(self, body):
+        return _dec_qid(body)
+
+    def _twalk(self, fid, newfid, names):
+        return (Twalk, struct.pack("<IIH", fid, newfid, len(names)) +
+                b"".join([_enc_s(x) for x in names]))
+
+    def _rwalk(self, body):
+        (count,) = _u16.unpack_from(body)
+        return [_dec_qid(body, 2 + i * _qid.size) for i in range(count)]
+
+    def _topen(self, fid, mode):
+        return (Topen, struct.pack("<IB", fid, mode))
+
+    def _ropen(self, body):
+        return (_dec_qid(body), _u32.unpack_from(body, _qid.size)[0])
+
+    def _tcreate(self, fid, name, perm, mode, extension=""):
+        return (Tcreate, _u32.pack(fid) + _enc_s(name) +
+                struct.pack("<IB", perm, mode) + _enc_s(extension))
+
+    _rcreate = _ropen
+
+    def _tread(self, fid, offset, count):
+        return (Tread, struct.pack("<IQI", fid, offset, count))
+
+    def _rread(self, body):
+        (count,) = _u32.unpack_from(body)
+        return body[4:4 + count]
+
+    def _twrite(self, fid, offset, data):
+        return (Twrite, struct.pack("<IQI", fid, offset, len(data)) + data)
+
+    def _rwrite(self, body):
+        return _u32.unpack_from(body)[0]
+
+    def _tclunk(self, fid):
+        return (Tclunk, _u32.pack(fid))
+
+    def _rclunk(self, body):
+        return None
+
+    def _tremove(self, fid):
+        return (Tremove, _u32.pack(fid))
+
+    _rremove = _rclunk
+
+    def _tstat(self, fid):
+        return (Tstat, _u32.pack(fid))
+
+    def _rstat(self, body):
+        return _dec_stat(body, 2)[0]
+
+    def _twstat(self, fid, stat):
+        data = _enc_stat(stat)
+        return (Twstat, _u32.pack(fid) + _u16.pack(len(data)) + data)
+
+    _rwstat = _rclunk
+
+    # 8<-----------------------------------------------------------------
+    #
+    # requests
+    #
+    def version(self):
+        (mtype, body) = self._tversion(self.msize, "9P2000.u")
+        (msize, version) = self._decode("version",
+                                        self.recv(self.send(mtype, body,
+                                                            NOTAG)))
+        if version != "9P2000.u":
+            raise Error("unsupported protocol version: %s" % (version))
+        self.msize = msize
+        return version
+
+    def attach(self, aname=""):
+        """
+        Attach to the server, return the root fid
+        """
+        fid = self.new_fid()
+        self.call("attach", fid, NOFID, self.uname, aname)
+        self.root = fid
+        return fid
+
+    def walk(self, path, fid=None):
+        """
+        Walk ``path`` from ``fid`` (the root by default), return
+        the new fid
+        """
+        if fid is None:
+            fid = self.root or self.attach()
+        names = [x for x in path.split("/") if x]
+        newfid = self.new_fid()
+        qids = self.call("walk", fid, newfid, names)
+        if len(qids) != len(names):
+            raise Error("file not found: %s" % (path))
+        return newfid
+
+    def open(self, fid, mode=OREAD):
+        return self.call("open", fid, mode)
+
+    def create(self, fid, name, perm=0o644, mode=OREAD, extension=""):
+        return self.call("create", fid, name, perm, mode, extension)
+
+    def read(self, fid, offset, count):
+        return self.call("read", fid, offset, count)
+
+    def write(self, fid, offset, data):
+        return self.call("write", fid, offset, data)
+
+    def clunk(self, fid):
+        return self.call("clunk", fid)
+
+    def remove(self, fid):
+        return self.call("remove", fid)
+
+    def stat(self, fid):
+        return self.call("stat", fid)
+
+    def wstat(self, fid, stat):
+        return self.call("wstat", fid, stat)
+
+    # 8<-----------------------------------------------------------------
+    #
+    # files
+    #
+    def read_file(self, path):
+        """
+        Read the whole file, with pipelined Tread requests
+        """
+        fid = self.walk(path)
+        try:
+            iounit = self.open(fid, OREAD)[1] or self.msize - IOHDRSZ
+            chunks = []
+            offset = 0
+            while True:
+                # the length may be wrong before the first read syncs
+                # the inode, so read until a short chunk
+                batch = self.pipeline([("read", fid, offset + i * iounit,
+                                        iounit)
+                                       for i in range(self.window)])
+                for chunk in batch:
+                    if isinstance(chunk, Error):
+                        raise chunk
+                    chunks.append(chunk)
+                    if len(chunk) < iounit:
+                        return b"".join(chunks)
+                offset += self.window * iounit
+        finally:
+            self.clunk(fid)
+
+    def write_file(self, path, data):
+        """
+        Create or truncate the file and write ``data`` with
+        pipelined Twrite requests. The data is committed on clunk.
+        """
+        (parent, name) = ("/%s" % (path.strip("/"))).rsplit("/", 1)
+        try:
+            fid = self.walk(path)
+            iounit = self.open(fid, OWRITE | OTRUNC)[1]
+        except Error:
+            fid = self.walk(parent)
+            iounit = self.create(fid, name, 0o644, OWRITE)[1]
+        iounit = iounit or self.msize - IOHDRSZ
+        try:
+            for result in self.pipeline([
+                    ("write", fid, i, data[i:i + iounit])
+                    for i in range(0, len(data), iounit)]):
+                if isinstance(result, Error):
+                    raise result
+        finally:
+            self.clunk(fid)
+        return len(data)
+
+    def listdir(self, path="/"):
+        """
+        Return the list of Dir entries of the directory
+        """
+        fid = self.walk(path)
+        try:
+            iounit = self.open(fid, OREAD)[1] or self.msize - IOHDRSZ
+            entries = []
+            offset = 0
+            while True:
+                data = self.read(fid, offset, iounit)
+                if not data:
+                    return entries
+                offset += len(data)
+                position = 0
+                while position < len(data):
+                    (entry, position) = _dec_stat(data, position)
+                    entries.append(entry)
+        finally:
+            self.clunk(fid)
+
+    def close(self):
+        self.sock.close()
+
+
+class Loopback(object):
+    """
+    The pyvfs 9p server on one end of a socketpair, served by
+    a thread, and a ``Client`` on the other end. No listening
+    socket is used. Closing the client stops the server thread.
+
+    With ``address``, the server listens on it instead, like
+    pyvfs.server.Server does, see pyvfs.server.parse_address(),
+    and the client connects there. So real transports can be
+    compared; use port 0 for TCP.
+    """
+    def __init__(self, storage, msize=8192, chatty=False, window=32,
+                 address=None, port=0):
+        from py9p import py9p
+        from pyvfs.v9fs import v9fs
+        from pyvfs.server import listen9p
+
+        self.listener = None
+        if address is None:
+            (client, server) = socket.socketpair()
+            self.server = py9p.Server(listen=("127.0.0.1", 0),
+                                      chatty=chatty, dotu=True, msize=msize)
+            # only the socketpair is served
+            self.server.readpool.remove(self.server.sock)
+            self.server.sock.close()
+            self.server.readpool.append(server)
+            self.server.activesocks[server] = py9p.Sock(server, True,
+                                                        chatty)
+        else:
+            self.server = listen9p(address, port, chatty=chatty,
+                                   dotu=True, msize=msize)
+            self.listener = self.server.sock
+            client = socket.socket(self.listener.family, socket.SOCK_STREAM)
+            client.connect(self.listener.getsockname())
+        self.server.mount(v9fs(storage))
+        self.thread = threading.Thread(target=self.server.serve,
+                                       name="PyVFS 9p loopback")
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.client = Client(client, msize, window=window)
+        self.client.attach()
+
+    def close(self):
+        self.client.close()
+        if self.listener is not None:
+            # stop accepting, and wake up the server loop with
+            # the last connection, so it ends
+            name = self.listener.getsockname()
+            self.server.readpool.remove(self.listener)
+            wakeup = socket.socket(self.listener.family, socket.SOCK_STREAM)
+            wakeup.connect(name)
+            wakeup.close()
+        self.thread.join()
+        if self.listener is not None:
+            self.listener.close()
+            if isinstance(name, str) and name.startswith("/"):
+                os.unlink(name)
+
+    def __enter__(self):
+        return self.client
+
+    def __exit__(self, *argv):
+        self.close()
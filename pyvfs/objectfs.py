@@ -32,22 +32,25 @@ import types
 import stat
 import sys
 import ast
-import dis
+import json
+import time
 import weakref
+import threading
 import logging
 import traceback
-import inspect
-import uuid
 from abc import ABCMeta
 from copy import copy
-from pyvfs.vfs import Storage, Inode, Eexist, Eperm, restrict
+from collections import OrderedDict, deque
+from pyvfs.vfs import Storage, Inode, Eexist, Eperm, restrict, timed, \
+    _clock
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 if sys.version_info[0] > 2:
-    from configparser import ConfigParser
     unicode = str
     long = int
     basestring = (str, bytes)
-else:
-    from ConfigParser import SafeConfigParser as ConfigParser
 
 
 Skip = ABCMeta("Skip", (object,), {})
@@ -136,12 +139,133 @@ def _dir(obj):
         return [x for x in dir(obj) if not x.startswith("_")]
 
 
+def _cast(obj, data):
+    """
+    Cast data, written to a file, to the type of the
+    attribute's current value ``obj``.
+    """
+    if isinstance(data, bytes) and not isinstance(obj, bytes):
+        data = data.decode('utf-8')
+    if isinstance(obj, bool):
+        return data.strip().lower() in ("yes", "true", "on", "t", "1")
+    return type(obj)(data)
+
+
+def _fingerprint(obj):
+    """
+    A cheap fingerprint of a literal value, to be kept instead
+    of the value itself: ``(id, type, length, hash)``. Equal
+    values share all but the id; strings cache their hash, so
+    the same object costs nothing on repeated calls.
+    """
+    try:
+        key = hash(obj)
+    except TypeError:
+        key = None
+    size = len(obj) if isinstance(obj, (bytes, unicode)) else None
+    return (id(obj), type(obj), size, key)
+
+
+# max length of a name produced from ``__repr__()``
+REPR_LIMIT = 128
+# containers with more items than this are never repr'ed for names
+REPR_ITEMS_LIMIT = 64
+
+# default depth limit of ``.json`` and ``.msgpack`` dumps
+DUMP_DEPTH = 8
+
+# per-class name providers, see register_name_provider()
+name_providers = {}
+# repr-based names, cached per object identity:
+# id(obj) -> (weakref.ref(obj), name)
+_name_cache = {}
+
+
+def register_name_provider(klass, provider):
+    """
+    Register a callable, that returns automatic names for
+    objects of ``klass`` and its subclasses. The provider
+    receives the object and should return a string without
+    ``/``; if it fails or returns anything else, the default
+    naming is used. Use ``None`` as ``provider`` to remove
+    the registration.
+    """
+    if provider is None:
+        name_providers.pop(klass, None)
+    else:
+        name_providers[klass] = provider
+
+
+def _get_provider(obj):
+    if not name_providers:
+        return None
+    for klass in type(obj).__mro__:
+        if klass in name_providers:
+            return name_providers[klass]
+    return None
+
+
+def _get_ident(obj):
+    """
+    Cheap identifier: the first of ``key``, ``name`` or ``id``
+    attributes, that can be used as a file name.
+    """
+    for i in ("key", "name", "id"):
+        try:
+            text = str(getattr(obj, i))
+            if text.find("/") == -1:
+                return text
+        except:
+            pass
+    return None
+
+
+def _get_repr(obj):
+    """
+    Name from ``__repr__()``, truncated to REPR_LIMIT and cached
+    for the object lifetime. Objects, that can not be weakref'ed,
+    are not cached.
+    """
+    obj_id = id(obj)
+    try:
+        (ref, text) = _name_cache[obj_id]
+        if ref() is obj:
+            return text
+    except KeyError:
+        pass
+
+    text = obj.__repr__()
+    if len(text) > REPR_LIMIT:
+        text = "%s..." % (text[:REPR_LIMIT - 3])
+    try:
+        ref = weakref.ref(obj, lambda x: _name_cache.pop(obj_id, None))
+        _name_cache[obj_id] = (ref, text)
+    except TypeError:
+        pass
+    return text
+
+
 def _get_name(obj, template=None):
     """
-    Get automatic name for an object.
+    Get automatic name for an object. The order is:
+
+    * function name for functions
+    * ``name_template``, if defined
+    * name provider, registered for the object's class
+    * ``__repr__()``, if the class defines its own one
+    * ``key``, ``name`` or ``id`` attribute with the object
+      address, e.g. ``Item [worker] at 0x7f...``, since those
+      may be not unique
+    * default ``__repr__()``
+
+    Names from ``__repr__()`` are cached per object, so use
+    ``name_template`` or a name provider for objects that
+    should be renamed on the fly. The same goes for exported
+    roots: without them, the root keeps the name it got on
+    export.
     """
     if isinstance(obj, types.FunctionType):
-        return obj.func_name
+        return obj.__name__
 
     if isinstance(template, basestring) and template:
         if template[0] == '@':
@@ -149,29 +273,344 @@ def _get_name(obj, template=None):
         elif template[0] == '#':
             attr = template[template.find('{') + 1:template.find('}')]
             return template[1:].format(**{attr: str(getattr(obj, attr))})
+
+    provider = _get_provider(obj)
+    if provider is not None:
+        try:
+            text = provider(obj)
+            if isinstance(text, basestring) and text.find("/") == -1:
+                return text
+        except:
+            pass
+
     try:
-        text = obj.__repr__()
-        if text.find("/") == -1:
-            return text
+        klass = obj.__class__
+        if klass.__repr__ is object.__repr__:
+            # the default repr is useless as a name, try to
+            # get something better before falling back to it;
+            # keep the address, as the default repr does, so
+            # the name is unique
+            obj_id = _get_ident(obj)
+            if obj_id is not None:
+                return "%s [%s] at 0x%x" % (klass.__name__, obj_id,
+                                            id(obj))
+            return "<%s.%s object at 0x%x>" % (klass.__module__,
+                                               klass.__name__, id(obj))
+        if not (isinstance(obj, (List, dict)) and
+                len(obj) > REPR_ITEMS_LIMIT):
+            text = _get_repr(obj)
+            if text.find("/") == -1:
+                return text
     except:
         pass
 
     try:
-        obj_id = "0x%x" % (id(obj))
-        for i in ("key", "name", "id"):
-            try:
-                text = str(getattr(obj, i))
-                if text.find("/") == -1:
-                    obj_id = text
-                    break
-            except:
-                pass
-
+        obj_id = _get_ident(obj) or "0x%x" % (id(obj))
         return "%s [%s]" % (obj.__class__.__name__, obj_id)
     except:
         return "0x%x" % (id(obj))
 
 
+# parameter without default value; inspect, dis and uuid are
+# imported on the first use, they are not cheap to load
+_empty = object()
+# signature templates, cached per code object
+_signatures = weakref.WeakKeyDictionary()
+
+
+class _Signature(object):
+    """
+    Function signature template for ``call`` files. Is built
+    once per function, see _get_signature().
+    """
+    def __init__(self, func):
+        # [(name, prefix, default), ...]
+        self.params = []
+        self.varargs = None
+        self.varkw = None
+        import inspect
+        if hasattr(inspect, "signature"):
+            for param in inspect.signature(func).parameters.values():
+                prefix = ""
+                if param.kind == param.VAR_POSITIONAL:
+                    prefix = "*"
+                    self.varargs = param.name
+                elif param.kind == param.VAR_KEYWORD:
+                    prefix = "**"
+                    self.varkw = param.name
+                default = param.default
+                if default is param.empty:
+                    default = _empty
+                self.params.append((param.name, prefix, default))
+        else:
+            spec = inspect.getargspec(func)
+            defaults = spec.defaults or ()
+            def_start = len(spec.args) - len(defaults)
+            for (i, name) in enumerate(spec.args):
+                if i >= def_start:
+                    default = defaults[i - def_start]
+                else:
+                    default = _empty
+                self.params.append((name, "", default))
+            if spec.varargs:
+                self.params.append((spec.varargs, "*", _empty))
+                self.varargs = spec.varargs
+            if spec.keywords:
+                self.params.append((spec.keywords, "**", _empty))
+                self.varkw = spec.keywords
+        self.positional = [x[0] for x in self.params if not x[1]]
+        self.template = {}
+
+    def get_args(self, skip=None):
+        skip = tuple(skip or ())
+        if skip not in self.template:
+            sig = []
+            for (name, prefix, default) in self.params:
+                if name in skip:
+                    continue
+                if default is _empty:
+                    sig.append("%s%s" % (prefix, name))
+                else:
+                    if isinstance(default, basestring):
+                        default = repr(default)
+                    sig.append("%s=%s" % (name, default))
+            self.template[skip] = sig
+        return self.template[skip]
+
+    def bind(self, func, values):
+        """
+        Convert parsed ``call`` file values into (args, kwarg)
+        """
+        kwarg = dict(values)
+        args = []
+        if self.varargs is not None and self.varargs in kwarg:
+            positional = self.positional
+            if getattr(func, "__self__", None) is not None:
+                positional = positional[1:]
+            for name in positional:
+                if name not in kwarg:
+                    break
+                args.append(kwarg.pop(name))
+            args.extend(kwarg.pop(self.varargs))
+        if self.varkw is not None and self.varkw in kwarg:
+            kwarg.update(kwarg.pop(self.varkw))
+        return (args, kwarg)
+
+
+def _unwrap(func):
+    """
+    Return the innermost function of ``functools.wraps()``
+    decorators: all the functions, wrapped by one decorator,
+    share the code of the wrapper
+    """
+    func = getattr(func, "__func__", func)
+    seen = set()
+    while hasattr(func, "__wrapped__") and id(func) not in seen:
+        seen.add(id(func))
+        func = func.__wrapped__
+    return func
+
+
+def _get_signature(func):
+    """
+    Get cached _Signature. The cache is keyed on the code
+    object, since functions may be weakref proxies, that can
+    not be weakref'ed again; the defaults, positional and
+    keyword-only, are checked to tell apart functions sharing
+    the code, e.g. closures. Decorated functions are keyed on
+    the code of the wrapped one.
+    """
+    func = getattr(func, "__func__", func)
+    inner = _unwrap(func)
+    code = getattr(inner, "__code__", None)
+    defaults = getattr(inner, "__defaults__", None)
+    kwdefaults = getattr(inner, "__kwdefaults__", None)
+    try:
+        (cached, kwcached, sig) = _signatures[code]
+        if cached is defaults and kwcached is kwdefaults:
+            return sig
+    except (KeyError, TypeError):
+        pass
+    sig = _Signature(func)
+    if code is not None:
+        _signatures[code] = (defaults, kwdefaults, sig)
+    return sig
+
+
+_constants = {"None": None,
+              "True": True,
+              "False": False}
+
+
+def _literal(text):
+    """
+    ``ast.literal_eval()`` with fast paths for simple values
+    """
+    if text in _constants:
+        return _constants[text]
+    try:
+        return int(text)
+    except ValueError:
+        return ast.literal_eval(text)
+
+
+def _parse_call(text):
+    """
+    Parse a ``call`` file. Lines ``name = value`` (or
+    ``name: value``) are collected, section headers, comments
+    and the template lines without values are skipped.
+    """
+    values = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line[0] in ("#", ";", "["):
+            continue
+        sep = min([x for x in (line.find("="), line.find(":")) if x > 0] or
+                  [-1])
+        if sep < 0:
+            continue
+        name = line[:sep].strip().lstrip("*")
+        values[name] = _literal(line[sep + 1:].strip())
+    return values
+
+
+# rendered function code, cached per code object
+_code_cache = weakref.WeakKeyDictionary()
+
+
+def _get_code(func):
+    """
+    Return (text, is_source): the function source or, if it
+    is not available, the disassembled code. The disassembly
+    is rendered into a string, without touching sys.stdout.
+    Decorated functions show the code of the wrapped one.
+    """
+    func = _unwrap(func)
+    code = func.__code__
+    try:
+        return _code_cache[code]
+    except (KeyError, TypeError):
+        pass
+    import dis
+    import inspect
+    try:
+        ret = (inspect.getsource(func), True)
+    except Exception:
+        if hasattr(dis, "Bytecode"):
+            ret = (dis.Bytecode(code).dis(), False)
+        else:
+            ret = ("# disassembly is not available\n", False)
+    try:
+        _code_cache[code] = ret
+    except TypeError:
+        pass
+    return ret
+
+
+def _invoke(func, args, kwarg, queued):
+    """
+    Run an exported function in a worker and return
+    (result, queue time, run time)
+    """
+    started = time.time()
+    try:
+        result = str(func(*args, **kwarg))
+    except:
+        result = traceback.format_exc()
+    return (result, started - queued, time.time() - started)
+
+
+def _unproxy(func):
+    """
+    Get the function behind a weakref proxy by its qualified
+    name, as pickle does. Only module-level functions can be
+    resolved, the rest are returned as is.
+    """
+    if not isinstance(func, weakref.ProxyTypes):
+        return func
+    try:
+        obj = sys.modules[func.__module__]
+        for name in getattr(func, "__qualname__", func.__name__).split("."):
+            obj = getattr(obj, name)
+        if obj.__code__ is func.__code__:
+            return obj
+    except Exception:
+        pass
+    return func
+
+
+class Ebusy(Exception):
+    pass
+
+
+class CallPool(object):
+    """
+    Worker pool for exported functions. Calls are run by
+    a ``concurrent.futures`` executor, ``kind`` can be ``thread``,
+    ``process`` or an executor instance. No more than ``limit``
+    calls can be queued or running at the same time, the rest
+    are rejected with Ebusy.
+
+    With ``process`` pools, the function, its arguments and
+    result should be picklable.
+    """
+    def __init__(self, kind="thread", workers=4, limit=None):
+        if kind == "thread":
+            from concurrent.futures import ThreadPoolExecutor
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+        elif kind == "process":
+            from concurrent.futures import ProcessPoolExecutor
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = kind
+        self.pickle = kind == "process"
+        self.limit = limit or workers * 4
+        self.slots = threading.BoundedSemaphore(self.limit)
+
+    def submit(self, func, args, kwarg):
+        if not self.slots.acquire(False):
+            raise Ebusy("call limit %i reached" % (self.limit))
+        if self.pickle:
+            func = _unproxy(func)
+        try:
+            future = self.executor.submit(_invoke, func, args, kwarg,
+                                          time.time())
+        except:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda x: self.slots.release())
+        return future
+
+
+# call pools, shared by exports with the same configuration
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(config):
+    """
+    Get CallPool for the export configuration, see
+    ``call_pool``, ``call_workers`` and ``call_limit``
+    options. Return None for synchronous calls.
+    """
+    kind = config.get("call_pool", None)
+    if kind is None:
+        return None
+    key = (kind if isinstance(kind, basestring) else id(kind),
+           config.get("call_workers", 4),
+           config.get("call_limit", None))
+    with _pools_lock:
+        if key not in _pools:
+            try:
+                _pools[key] = CallPool(kind, *key[1:])
+            except Exception:
+                logging.error("can not create call pool %s, "
+                              "falling back to synchronous calls\n%s" %
+                              (key, traceback.format_exc()))
+                _pools[key] = None
+        return _pools[key]
+
+
 class vRepr(Inode):
     """
     Sometimes ``__repr__()`` returns a string that can not be used
@@ -195,6 +634,247 @@ class vRepr(Inode):
             pass
 
 
+# _dump() result for objects, that are not exported at all
+_SKIP = object()
+
+
+def _dump(obj, path, depth, blacklist, seen, ident=None):
+    """
+    Build a JSON-serializable tree of the object, in one pass
+    and without inodes. The rules are the same as for the
+    filesystem: private names, blacklisted names and ``Skip``
+    objects are omitted. An object already dumped is replaced
+    with ``{"$ref": path}``, an object below the depth limit --
+    with ``{"$truncated": true}``.
+    """
+    if isinstance(obj, File):
+        if isinstance(obj, bytes):
+            return obj.decode('utf-8', 'replace')
+        if isinstance(obj, (bool, int, long, float, unicode,
+                            type(None))):
+            return obj
+        return repr(obj)
+    if isinstance(obj, (Skip, Func, types.MethodType)):
+        return _SKIP
+    if ident is None:
+        ident = id(obj)
+    if ident in seen:
+        return {"$ref": seen[ident][1]}
+    if depth <= 0:
+        return {"$truncated": True}
+    # keep the object, so its id() is not reused during the dump
+    seen[ident] = (obj, path or "/")
+    if isinstance(obj, List):
+        ret = []
+        for (i, item) in enumerate(obj):
+            item = _dump(item, "%s/%i" % (path, i), depth - 1,
+                         blacklist, seen)
+            ret.append(None if item is _SKIP else item)
+        return ret
+    ret = OrderedDict()
+    for name in _dir(obj):
+        if name.startswith("_") or \
+                (isinstance(blacklist, List) and name in blacklist):
+            continue
+        try:
+            item = _getattr(obj, name)
+        except:
+            continue
+        item = _dump(item, "%s/%s" % (path, name), depth - 1,
+                     blacklist, seen)
+        if item is not _SKIP:
+            ret[name] = item
+    return ret
+
+
+def _tree(parent, seen=None, path=""):
+    """
+    Dump the directory's object, see _dump(). In a directory
+    without an object, dump all the objects exported there.
+    """
+    seen = {} if seen is None else seen
+    if parent.observe is not None:
+        ret = _dump(parent.observe, "",
+                    parent.kwarg.get("dump_depth", DUMP_DEPTH),
+                    parent.blacklist, seen, parent.cycle_id)
+        # e.g. function directories
+        return None if ret is _SKIP else ret
+    # remove collected roots before the listing
+    parent.storage.sync(parent)
+    ret = OrderedDict()
+    for (name, inode) in sorted(parent.children.items()):
+        if not isinstance(inode, vInode) or \
+                name in parent.auto_names or \
+                name in parent.special_names:
+            continue
+        # every export has its own options
+        try:
+            if inode.observe is None:
+                item = _tree(inode, seen, "%s/%s" % (path, name))
+            else:
+                item = _dump(inode.observe, "%s/%s" % (path, name),
+                             inode.kwarg.get("dump_depth", DUMP_DEPTH),
+                             inode.blacklist, seen, inode.cycle_id)
+        except ReferenceError:
+            continue
+        if item is not _SKIP:
+            ret[name] = item
+    return ret
+
+
+def _flatten(tree, path="", ret=None):
+    """
+    Flatten a _dump() tree into {path: value} of its leaves,
+    the fingerprint of a subtree for .watch files
+    """
+    ret = {} if ret is None else ret
+    if isinstance(tree, dict) and \
+            not ("$ref" in tree or "$truncated" in tree):
+        for (name, item) in tree.items():
+            _flatten(item, "%s/%s" % (path, name), ret)
+    elif isinstance(tree, list):
+        for (index, item) in enumerate(tree):
+            _flatten(item, "%s/%i" % (path, index), ret)
+    else:
+        ret[path] = repr(tree) if isinstance(tree, dict) else tree
+    return ret
+
+
+class vDump(Inode):
+    """
+    The ``.json`` file, placed in every directory, contains the
+    whole subtree of the directory's object, so one read gets
+    all the values that otherwise need a walk and a read per
+    attribute. The tree is built directly from the objects,
+    without inodes, down to ``dump_depth`` levels (the export
+    option, default: ``DUMP_DEPTH``). See ``_dump()`` for the
+    format details.
+
+    In a directory without an object, e.g. the storage root or
+    a ``basedir``, the file contains dumps of all the objects
+    exported there, by name.
+
+    If the ``msgpack`` module is available, the same tree is
+    also provided in the ``.msgpack`` file.
+    """
+
+    def encode(self, tree):
+        chunks = []
+        for chunk in _json_encoder.iterencode(tree):
+            chunks.append(chunk)
+            if len(chunks) >= 1024:
+                self.write("".join(chunks).encode('utf-8'))
+                del chunks[:]
+        chunks.append("\n")
+        self.write("".join(chunks).encode('utf-8'))
+
+    def sync(self, data):
+        self.seek(0)
+        self.truncate()
+        try:
+            self.encode(_tree(self.parent))
+        except:
+            self.write(traceback.format_exc().encode('utf-8'))
+
+
+class vMsgpackDump(vDump):
+    """
+    The ``.msgpack`` file, see vDump
+    """
+
+    def encode(self, tree):
+        self.write(msgpack.packb(tree, use_bin_type=True))
+
+
+_json_encoder = json.JSONEncoder(separators=(",", ":"), default=repr)
+
+
+class vWatch(Inode):
+    """
+    The ``.watch`` file, placed in every directory. A read
+    blocks until something changes in the directory subtree,
+    and returns the changed paths, relative to the directory,
+    one per line::
+
+        $ while true; do cat .watch; done
+        port
+        servers/0
+
+    A change is recorded, when:
+
+    * a value is written to the filesystem
+    * an application calls ObjectFS.notify()
+    * a sync finds a new value of a file, or new / removed
+      attributes of a directory
+    * a periodic scan finds new values in the subtree of a
+      watched directory, while there are readers; see
+      ObjectFS.scan()
+
+    A read returns the changes since the previous read of the
+    file. After ``watch_timeout`` seconds without changes, it
+    returns nothing. A line with ``.`` means that some changes
+    were lost, since the change log is limited.
+
+    The read position is per file, not per reader, so several
+    readers of the same ``.watch`` share the changes.
+    """
+    blocking = True
+    # the change log sequence number, read up to
+    since = None
+    # when a waiting read times out
+    deadline = None
+    last_read = 0
+
+    def changes(self):
+        """
+        Return the changed paths since the last read, and
+        whether some changes were lost
+        """
+        prefix = self.parent.absolute_path() + "/"
+        ret = OrderedDict()
+        lost = False
+        changes = self.storage.changes
+        if changes and changes[0][0] > self.since + 1:
+            lost = True
+        for (seq, path) in reversed(changes):
+            if seq <= self.since:
+                break
+            if path.startswith(prefix):
+                ret[path[len(prefix):]] = True
+        return (list(reversed(ret)), lost)
+
+    def pending(self):
+        storage = self.storage
+        with storage.lock:
+            if self.since is None:
+                self.since = storage.change_seq
+            storage.watch(self)
+            now = _clock()
+            if self.deadline is None:
+                self.deadline = now + storage.watch_timeout
+            if storage.change_seq > self.since:
+                (changes, lost) = self.changes()
+                if changes or lost:
+                    return 0
+            return max(self.deadline - now, 0)
+
+    def sync(self, data):
+        # only reads wait for changes, see pending(), so keep the
+        # buffer for other syncs, like stat() or listings
+        if self.deadline is None:
+            return
+        (changes, lost) = self.changes()
+        self.since = self.storage.change_seq
+        self.deadline = None
+        self.last_read = _clock()
+        self.seek(0)
+        self.truncate()
+        if lost:
+            changes.insert(0, ".")
+        for path in changes:
+            self.write(("%s\n" % (path)).encode('utf-8'))
+
+
 class vInode(Inode):
     """
     An inode, that can represent and track a Python object.
@@ -208,8 +888,18 @@ class vInode(Inode):
     from the filesystem.
     """
 
-    auto_names = [".repr", ]
+    auto_names = frozenset((".repr", ".json", ".msgpack", ".watch",
+                            ".transaction"))
     mode = stat.S_IFDIR
+    # id() of the observed object, registered in the cycle stack
+    cycle_id = None
+    # symlink target inode, see _link()
+    link_target = None
+    # weakref, that queues the root for removal when the
+    # observed object is collected, see ObjectFS.track()
+    finalizer = None
+    # changes are recorded only after the first sync
+    synced = False
 
     @classmethod
     def get_mode(cls, obj, orig_mode, **config):
@@ -267,17 +957,19 @@ class vInode(Inode):
         try:
             if self.root:
                 self.observe = obj
-                self.stack[id(self.observe)] = self
+                if obj is not None:
+                    self.cycle_id = id(obj)
+                    self.stack[self.cycle_id] = self
+                    exports = getattr(self.storage, "exports", None)
+                    if exports is not None:
+                        exports[self.cycle_id] = self
             else:
                 # cycle links detection
                 if cycle_detect != "none" and self.mode & stat.S_IFDIR:
                     self._check_cycle()
         except Eexist as e:
             if cycle_detect == "symlink":
-                self.write(self.relative_path(e.target.absolute_path()))
-                e.target.cleanup[str(id(self))] = (self.storage.destroy,
-                                                   (self,))
-                self.mode = stat.S_IFLNK
+                self._link(e.target)
             else:
                 self.destroy()
                 raise e
@@ -286,6 +978,18 @@ class vInode(Inode):
             raise e
         if (self.mode & stat.S_IFDIR) and kwarg.get("repr", True):
             self.children[".repr"] = vRepr(".repr", self)
+        if (self.mode & stat.S_IFDIR) and kwarg.get("dump", True):
+            self.children[".json"] = vDump(".json", self)
+            if msgpack is not None:
+                self.children[".msgpack"] = vMsgpackDump(".msgpack", self)
+        if (self.mode & stat.S_IFDIR) and kwarg.get("watch", True):
+            self.children[".watch"] = vWatch(".watch", self)
+        if self.root and (obj is not None) and \
+                (self.mode & stat.S_IFDIR) and \
+                kwarg.get("transaction", True):
+            self.children[".transaction"] = vTransaction(
+                ".transaction", self, cycle_detect="none",
+                on_commit=kwarg.get("on_commit", None))
 
     def relative_path(self, target):
         to_root = [".."] * (len(self.absolute_path().split("/")) - 2)
@@ -320,32 +1024,107 @@ class vInode(Inode):
     def _set_observe(self, obj):
 
         try:
-            # we can not use callback here, 'cause it forces
-            # weakref to generate different proxies for one
-            # object and it breaks cycle reference detection
-            #
-            # this won't work: lambda x: self.storage.remove(self)
+            # cycle detection uses id() of the referent, so the
+            # proxy is only to avoid holding the object
             if not self.kwarg.get("use_weakrefs", True):
                 raise Exception()
             wp = weakref.proxy(obj)
         except:
             wp = obj
+        else:
+            track = getattr(self.storage, "track", None)
+            if self.root and track is not None:
+                track(self, obj)
 
         self.__observe = wp
 
     observe = property(_get_observe, _set_observe)
 
     def _check_cycle(self):
-        try:
-            if not self.kwarg.get("use_weakrefs", True):
-                raise Exception()
-            self_id = id(weakref.proxy(self.observe))
-        except:
-            self_id = id(self.observe)
-        if self_id in self.stack:
-            raise Eexist(self.stack[self_id])
-        self.stack[self_id] = self
-        self.cleanup["stack"] = (self.stack.pop, (id(self.observe),))
+        """
+        Raise Eexist with the target inode, if the observed object
+        is already represented in the same export root, or if it
+        is exported as a root by itself. The stack is keyed by
+        the referent id, so no weakref proxies are involved; the
+        id may be reused by a new object, after the old one is
+        replaced and collected, so the target is checked to still
+        observe the object.
+        """
+        obj_id = id(self.observe)
+        target = self.stack.get(obj_id)
+        if target is None or not target.observes(obj_id):
+            target = None
+            exports = getattr(self.storage, "exports", None)
+            if exports is not None:
+                target = exports.get(obj_id)
+        if target is not None and target.observes(obj_id):
+            raise Eexist(target)
+        self.cycle_id = obj_id
+        self.stack[obj_id] = self
+
+    def observes(self, obj_id):
+        """
+        True, if the inode still observes the object with the id
+        """
+        if self.cycle_id != obj_id:
+            return False
+        obj = self.observe
+        if isinstance(obj, weakref.ProxyTypes):
+            # a live proxy refers to the object it was created for
+            try:
+                obj.__class__
+            except ReferenceError:
+                return False
+            return True
+        return id(obj) == obj_id
+
+    def _link(self, target):
+        """
+        Turn the inode into a symlink to ``target``. The link is
+        registered in the storage reverse-reference index, so
+        ``target`` destruction removes all the links in one pass.
+        """
+        self.mode = stat.S_IFLNK
+        self.link_target = target
+        links = getattr(self.storage, "links", None)
+        if links is not None:
+            links.setdefault(id(target), {})[id(self)] = self
+
+    def readlink(self):
+        """
+        The link path is computed on demand, so it follows
+        renames of the target and its parents.
+        """
+        if self.link_target is None:
+            return Inode.readlink(self)
+        return self.relative_path(
+            self.link_target.absolute_path()).encode('utf-8')
+
+    @restrict
+    def destroy(self):
+        # dropping the weakref cancels the callback
+        self.finalizer = None
+        links = getattr(self.storage, "links", None)
+        if links is not None:
+            if self.link_target is not None:
+                referrers = links.get(id(self.link_target), {})
+                referrers.pop(id(self), None)
+                if not referrers:
+                    links.pop(id(self.link_target), None)
+                self.link_target = None
+            for link in list(links.pop(id(self), {}).values()):
+                link.link_target = None
+                self.storage.destroy(link)
+        if self.cycle_id is not None:
+            if self.stack.get(self.cycle_id) is self:
+                del self.stack[self.cycle_id]
+            if self.root:
+                exports = getattr(self.storage, "exports", None)
+                if exports is not None and \
+                        exports.get(self.cycle_id) is self:
+                    del exports[self.cycle_id]
+            self.cycle_id = None
+        return Inode.destroy(self)
 
     @restrict
     def commit(self, data):
@@ -358,19 +1137,29 @@ class vInode(Inode):
         """
         if (self.mode & stat.S_IFREG) and \
                 self.name != ".repr":
+            # the buffer holds the written text, not the value,
+            # so the next sync rewrites it
+            self.written = False
             try:
                 data = data or self.getvalue()
-                if isinstance(self.observe, bool):
-                    _setattr(self.parent.observe, self.name,
-                             data.lower() in
-                             ("yes", "true", "on", "t", "1"))
-                else:
-                    _setattr(self.parent.observe, self.name,
-                             type(self.observe)(data))
+                value = _cast(self.observe, data)
+                _setattr(self.parent.observe, self.name, value)
+                # recorded here, so the next sync has nothing to
+                # report
+                self.fingerprint = _fingerprint(value)
+                self.changed((self.absolute_path(),))
             except Exception as e:
                 logging.debug("[%s] commit() failed: %s" % (
                     self.path, str(e)))
 
+    def changed(self, paths):
+        """
+        Record changes, if the storage supports it, see vWatch
+        """
+        changed = getattr(self.storage, "changed", None)
+        if changed is not None:
+            changed(paths)
+
     @restrict
     def create(self, name, mode=0, klass=None, **kwarg):
         if not kwarg.get('is_internal', False):
@@ -389,21 +1178,34 @@ class vInode(Inode):
         """
         Synchronize directory subtree with the object's state.
 
-        * Remove directories of GC'ed objects
+        * Remove directories of GC'ed objects (exported roots are
+          queued for removal by weakref callbacks, see
+          ObjectFS.track())
         * Add inodes for new object's attributes (dirs)
         * Remove inodes of not existing attributes (dirs)
         * Write data from an attribute to the I/O buffer (file)
         """
         if self.observe is None:
+            for i in ("flush_exports", "reap"):
+                method = getattr(self.storage, i, None)
+                if method is not None:
+                    method()
             for (i, k) in list(self.children.items()):
+                # roots of collected objects are removed by the
+                # storage reaper, so only the roots that can be
+                # renamed on the fly should be checked here
+                if getattr(k, "finalizer", None) is not None and \
+                        k.name_template is None and \
+                        not name_providers:
+                    continue
                 try:
                     if hasattr(k, "observe"):
-                        _dir(k.observe)
-                        if k.observe is not None:
-                            if _get_name(k.observe,
-                                         k.name_template) != i:
-                                k.name = _get_name(k.observe,
-                                                   k.name_template)
+                        obj = k.observe
+                        _dir(obj)
+                        if obj is not None:
+                            name = _get_name(obj, k.name_template)
+                            if name != i:
+                                k.name = name
                 except:
                     logging.debug("destroying %s" % (k.name))
                     logging.debug("%s" % (k.cleanup))
@@ -414,10 +1216,10 @@ class vInode(Inode):
                 obs = set(_dir(self.observe))
             except:
                 obs = set()
-            to_delete = chs - obs -\
-                set(self.special_names) -\
-                set(self.auto_names) -\
-                set(self.static_names)
+            to_delete = [x for x in chs - obs
+                         if x not in self.auto_names and
+                         x not in self.static_names and
+                         x not in self.special_names]
             to_create = obs - chs
             for i in to_delete:
                 self.children[i].destroy()
@@ -426,22 +1228,49 @@ class vInode(Inode):
                                     obj=_getattr(self.observe, i),
                                     mode=self.orig_mode,
                                     **self.kwarg)
+            if self.synced and (to_delete or to_create):
+                prefix = self.absolute_path()
+                self.changed(["%s/%s" % (prefix, x) for x
+                              in sorted(to_create) + sorted(to_delete)])
+            self.synced = True
 
 
 class vFunction(vInode):
     """
-    A function directory. It contains three files (among others):
+    A function directory. It contains four files (among others):
 
     * ``call`` -- function call interface
     * ``context`` -- creates new ``call`` files
     * ``code`` -- function source
+    * ``stats`` -- state and timings of the calls
+
+    By default, the function runs synchronously on the ``call``
+    file close. With the ``call_pool`` export option, calls
+    are run in a worker pool, see CallPool:
+
+    * ``call_pool`` -- ``thread``, ``process`` or an executor
+    * ``call_workers`` -- number of workers (default: 4)
+    * ``call_limit`` -- max calls queued or running at the same
+      time (default: 4 per worker)
+
+    Call files, created by ``context``, are removed when they
+    are not used for ``context_ttl`` seconds (default: 600), or
+    when there are more than ``context_limit`` of them (default:
+    1024), the least recently used first. Pending calls are not
+    removed on TTL.
     """
     mode = stat.S_IFDIR
 
     def __init__(self, *argv, **kwarg):
         kwarg['cycle_detect'] = 'none'
+        kwarg['transaction'] = False
 
         vInode.__init__(self, *argv, **kwarg)
+        self.pool = _get_pool(kwarg)
+        # call contexts, the least recently used first
+        self.contexts = OrderedDict()
+        self.context_ttl = kwarg.get("context_ttl", 600)
+        self.context_limit = kwarg.get("context_limit", 1024)
         try:
             self.children["code"] = vFunctionCode("code", self,
                                                   cycle_detect="none")
@@ -449,50 +1278,57 @@ class vFunction(vInode):
                                                   cycle_detect="none")
             self.children["context"] = vFunctionContext("context", self,
                                                         cycle_detect="none")
+            self.children["stats"] = vFunctionStats("stats", self,
+                                                    cycle_detect="none")
         except Exception as e:
             self.destroy()
             raise e
 
     def sync(self, data):
-        pass
+        self.reap()
+
+    @restrict
+    def remove(self, inode):
+        self.contexts.pop(inode.name, None)
+        return vInode.remove(self, inode)
+
+    def touch(self, inode):
+        """
+        Mark a call context as recently used
+        """
+        inode.touched = time.time()
+        if inode.name in self.contexts:
+            self.contexts[inode.name] = self.contexts.pop(inode.name)
+
+    def reap(self):
+        """
+        Remove expired and excessive call contexts
+        """
+        now = time.time()
+        for i in range(len(self.contexts)):
+            name = next(iter(self.contexts))
+            inode = self.contexts[name]
+            if len(self.contexts) <= self.context_limit:
+                if self.context_ttl is None or \
+                        inode.touched + self.context_ttl > now:
+                    break
+                if inode.future is not None:
+                    self.touch(inode)
+                    continue
+            inode.destroy()
+            self.contexts.pop(name, None)
 
     def get_args(self, skip=None):
-        if skip is None:
-            skip = []
-        sig = []
-        sig_i = inspect.getargspec(self.observe)
-        # get start index for arguments with default values
-        try:
-            def_start = len(sig_i.args) - len(sig_i.defaults)
-        except:
-            def_start = len(sig_i.args)
-        for i in range(len(sig_i.args)):
-            if sig_i.args[i] in skip:
-                continue
-            if i >= def_start:
-                # get argument with default value
-                value = sig_i.defaults[i - def_start]
-                if isinstance(value, bytes):
-                    value = "\"%s\"" % (value)
-                sig.append("%s=%s" % (sig_i.args[i], value))
-            else:
-                # get argument w/o default value
-                sig.append("%s" % (sig_i.args[i]))
-        # add positional arguments list (if exists)
-        if sig_i.varargs:
-            sig.append("*%s" % (sig_i.varargs))
-        # add keyword arguments dict (if exists)
-        if sig_i.keywords:
-            sig.append("**%s" % (sig_i.keywords))
-        return sig
+        return _get_signature(self.observe).get_args(skip)
 
 
 class vFunctionCall(vInode):
     """
     The ``call`` file initially contains the function parameters
-    to be filled in. It is in .ini format, all parameters should
-    be placed in the [call] section. Each parameter should have
-    a value (only simple literals allowed yet).
+    to be filled in. It is in .ini-like format, one ``name = value``
+    per line; the [call] section header and the lines without
+    values are ignored. Each parameter should have a value (only
+    simple literals allowed yet).
 
     For example, you have the next ``call`` file::
 
@@ -527,6 +1363,10 @@ class vFunctionCall(vInode):
         vim, please note, that by default it does not write files
         in-place, but use create/mv scheme. It will not work with
         ``call`` files.
+
+    If the function runs in a worker pool (see vFunction), the
+    file contains ``pending`` until the result is ready. While
+    the call is pending, new writes are ignored.
     """
     mode = stat.S_IFREG
     called = False
@@ -535,29 +1375,74 @@ class vFunctionCall(vInode):
     def observe(self):
         return self.parent.observe
 
+    future = None
+    # (queue time, run time) of the last call
+    timing = None
+    # last access time, used to expire call contexts
+    touched = 0
+
+    @property
+    def state(self):
+        if self.future is not None:
+            return "pending"
+        if self.timing is not None:
+            return "done"
+        return "idle"
+
+    def poll(self):
+        """
+        Collect the result of an asynchronous call, if it is ready
+        """
+        if self.future is None or not self.future.done():
+            return
+        try:
+            (result, wait, run) = self.future.result()
+            self.timing = (wait, run)
+        except:
+            result = traceback.format_exc()
+        self.future = None
+        self._set_result(result)
+
+    def _set_result(self, result):
+        self.seek(0)
+        self.truncate()
+        self.write(result.encode('utf-8'))
+
+    def open(self, data):
+        self.parent.touch(self)
+
     def sync(self, data):
-        if not self.called:
+        self.parent.touch(self)
+        if self.future is not None:
+            self.poll()
+            if self.future is not None:
+                self._set_result("pending\n")
+        elif not self.called:
             self.seek(0)
             self.truncate()
-            self.write("[call]\n%s" % ("\n".join(
-                self.parent.get_args(skip=("self",)))))
+            self.write(("[call]\n%s" % ("\n".join(
+                self.parent.get_args(skip=("self",))))).encode('utf-8'))
 
     def commit(self, data):
-        if self.length == 0:
+        self.parent.touch(self)
+        if self.length == 0 or self.future is not None:
             return
         self.called = True
-        self.seek(0)
-        config = ConfigParser()
         try:
-            config.readfp(self)
-            kwarg = dict([(x[0], ast.literal_eval(x[1])) for x
-                          in config.items('call')])
-            result = self.observe(**kwarg)
+            text = self.getvalue().decode('utf-8')
+            func = self.observe
+            (args, kwarg) = _get_signature(func).bind(func,
+                                                      _parse_call(text))
+            if self.parent.pool is not None:
+                self.future = self.parent.pool.submit(func, args, kwarg)
+                result = "pending\n"
+            else:
+                (result, wait, run) = _invoke(func, args, kwarg,
+                                              time.time())
+                self.timing = (wait, run)
         except:
             result = traceback.format_exc()
-        self.seek(0)
-        self.truncate()
-        self.write(str(result))
+        self._set_result(result)
 
 
 class vFunctionContext(vInode):
@@ -585,20 +1470,54 @@ class vFunctionContext(vInode):
     ``call``-files, that can be used independently.
     """
     mode = stat.S_IFREG
-    length = len("call-%s" % (uuid.uuid4()))
+    # "call-" and uuid4() string
+    length = len("call-") + 36
 
     @property
     def observe(self):
         return self.parent.observe
 
     def open(self, data):
+        import uuid
         new = vFunctionCall("call-%s" % (uuid.uuid4()), self.parent,
                             cycle_detect="none")
-        self.parent.auto_names.append(new.name)
+        self.parent.contexts[new.name] = new
+        self.parent.touch(new)
+        # after the creation: the oldest contexts go, so no more
+        # than context_limit remain
+        self.parent.reap()
         self.seek(0)
         self.truncate()
-        self.write(new.name)
+        self.write(new.name.encode('utf-8'))
+        self.seek(0)
+
+
+class vFunctionStats(vInode):
+    """
+    The ``stats`` file lists all the ``call`` files of the
+    function with their state (``idle``, ``pending`` or ``done``)
+    and the timings of the last call, in seconds: how long
+    the call waited for a worker and how long it run.
+    """
+    mode = stat.S_IFREG
+
+    @property
+    def observe(self):
+        return self.parent.observe
+
+    def sync(self, data):
         self.seek(0)
+        self.truncate()
+        self.write(("%-41s %-8s %-10s %s\n" % (
+            "# call", "state", "queued", "run")).encode('utf-8'))
+        for (i, k) in sorted(self.parent.children.items()):
+            if isinstance(k, vFunctionCall):
+                k.poll()
+                (wait, run) = k.timing or ("-", "-")
+                if k.timing:
+                    (wait, run) = ("%.6f" % wait, "%.6f" % run)
+                self.write(("%-41s %-8s %-10s %s\n" % (
+                    i, k.state, wait, run)).encode('utf-8'))
 
 
 class vFunctionCode(vInode):
@@ -616,23 +1535,119 @@ class vFunctionCode(vInode):
     def sync(self, data):
         self.seek(0)
         self.truncate()
-        # write function code
         try:
-            self.write(inspect.getsource(self.observe))
+            (text, is_source) = _get_code(self.observe)
+            if not is_source:
+                # write function signature
+                self.write(("#  %s(%s)\n\n" % (self.parent.name, ", ".join(
+                    self.parent.get_args()))).encode('utf-8'))
+            self.write(text.encode('utf-8'))
         except:
-            # write function signature
-            self.write("#  %s(%s)\n\n" % (self.parent.name, ", ".join(
-                self.parent.get_args())))
-            # disassemble the code
-            stdout = sys.stdout
-            stderr = sys.stderr
+            self.write(traceback.format_exc().encode('utf-8'))
+
+
+class vTransaction(vInode):
+    """
+    The ``.transaction`` file is created in every exported
+    root directory. It accepts a batch of assignments, one
+    per line, with paths relative to the root::
+
+        $ cat >.transaction <<EOF
+        port = 8080
+        options/verbose = True
+        servers/0 = 10.0.0.1
+        EOF
+
+    On close, all the values are cast to the types of the
+    current attribute values, just as with usual files, and
+    only if all of them succeed, they are applied at once,
+    under one storage lock acquisition. If an assignment fails,
+    e.g. on a read-only property, the assignments before it are
+    rolled back. The ``on_commit`` hook of the export runs once
+    per batch.
+
+    Read the file to get the result of the last batch.
+    """
+    mode = stat.S_IFREG
+
+    @property
+    def observe(self):
+        return self.parent.observe
+
+    def sync(self, data):
+        pass
+
+    def _resolve(self, path):
+        names = [x for x in path.split("/") if x]
+        if not names:
+            raise Exception("empty path")
+        obj = self.observe
+        for (index, name) in enumerate(names):
+            if name.startswith("_") or \
+                    (isinstance(self.blacklist, List) and
+                     name in self.blacklist):
+                raise Eperm(name)
+            parent = obj
+            obj = _getattr(parent, name)
+            # only paths, that are exported as directories: no
+            # modules, classes or functions, see ObjectFS.create()
+            if index < len(names) - 1 and \
+                    isinstance(obj, (Skip, Func, Cls, types.ModuleType,
+                                     types.MethodType)):
+                raise Eperm(name)
+        if not isinstance(obj, File):
+            raise Exception("not a literal: %s" % (path))
+        return (parent, names[-1], obj)
+
+    def commit(self, data):
+        data = data or self.getvalue()
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        batch = []
+        errors = []
+        for (lineno, line) in enumerate(data.splitlines()):
+            line = line.strip()
+            if not line or line[0] in ("#", ";"):
+                continue
+            (path, sep, value) = line.partition("=")
             try:
-                sys.stdout = sys.stderr = self
-                dis.dis(self.observe)
-            except:
-                traceback.print_exc()
-            sys.stdout = stdout
-            sys.stderr = stderr
+                if not sep:
+                    raise Exception("no value")
+                (parent, name, obj) = self._resolve(path.strip())
+                batch.append((parent, name, _cast(obj, value.strip()),
+                              "/".join([x for x in path.split("/")
+                                        if x.strip()]), obj,
+                              "%i: %s" % (lineno + 1, line)))
+            except Exception as e:
+                errors.append("%i: %s: %s" % (lineno + 1, line, repr(e)))
+        self.seek(0)
+        self.truncate()
+        if errors:
+            self.write(("failed, nothing applied\n%s\n" %
+                        ("\n".join(errors))).encode('utf-8'))
+            return
+        applied = []
+        for (parent, name, value, path, old, line) in batch:
+            try:
+                _setattr(parent, name, value)
+            except Exception as e:
+                # e.g. a read-only property: restore the values,
+                # that are already set
+                for (parent, name, value, path, old, x) in \
+                        reversed(applied):
+                    try:
+                        _setattr(parent, name, old)
+                    except Exception:
+                        logging.error("transaction rollback failed: "
+                                      "%s\n%s" %
+                                      (path, traceback.format_exc()))
+                self.write(("failed, rolled back\n%s: %s\n" %
+                            (line, repr(e))).encode('utf-8'))
+                return
+            applied.append((parent, name, value, path, old, line))
+        prefix = self.parent.absolute_path()
+        self.changed(["%s/%s" % (prefix, x[3].strip()) for x in batch])
+        self.write(("ok: %i\n" % (len(batch))).encode('utf-8'))
 
 
 class vLiteral(vInode):
@@ -645,10 +1660,23 @@ class vLiteral(vInode):
     from the previous data type.
     """
     mode = stat.S_IFREG
+    # the fingerprint of the last synced or committed value,
+    # not the value itself, and whether the buffer holds it
+    fingerprint = None
+    written = False
 
     def sync(self, data):
 
         data = data or self.observe
+        fingerprint = _fingerprint(data)
+        # literals are immutable: the same object is the same
+        # value, so the buffer is up to date
+        if self.written and fingerprint == self.fingerprint:
+            return
+        # an equal value in a new object is not a change
+        changed = self.synced and (self.fingerprint is None or
+                                   fingerprint[1:] != self.fingerprint[1:])
+        self.fingerprint = fingerprint
 
         self.seek(0)
         self.truncate()
@@ -659,6 +1687,10 @@ class vLiteral(vInode):
                 self.write(bytes(data))
         except:
             self.write(traceback.format_exc())
+        if changed:
+            self.changed((self.absolute_path(),))
+        self.synced = True
+        self.written = True
 
 
 class ObjectFS(Storage):
@@ -666,9 +1698,174 @@ class ObjectFS(Storage):
     ObjectFS storage class. Though there is no limit of
     ObjectFS instances, the module starts only one storage.
     """
+    # seconds between reaper runs, see track()
+    reap_interval = 0.1
+    # deferred exports: max queue length, max objects exported
+    # per the storage lock acquisition, seconds to collect a
+    # batch; see defer_export()
+    export_limit = 65536
+    export_batch = 1024
+    export_delay = 0.05
+    # .watch files: the change log length, seconds between
+    # scans of watched subtrees, max seconds a read waits;
+    # see vWatch
+    watch_log = 4096
+    watch_interval = 0.25
+    watch_timeout = 60
+
     def __init__(self):
+        # exported root objects: id(obj) -> root vInode
+        self.exports = {}
+        # symlinks reverse index: id(target) -> {id(link): link}
+        self.links = {}
+        # roots of collected objects, see track()
+        self.dead = deque()
+        self.reaper = None
+        # deferred exports, see defer_export()
+        self.exports_pending = deque()
+        self.export_lock = threading.Lock()
+        self.export_event = threading.Event()
+        self.export_counters = {"queued": 0,
+                                "dropped": 0,
+                                "expired": 0,
+                                "exported": 0}
+        self.exporter = None
+        # change log: (seq, path), see changed()
+        self.changes = deque(maxlen=self.watch_log)
+        self.change_seq = 0
+        # watched directories: id(.watch inode) -> (inode, fingerprint)
+        self.watching = {}
+        self.watcher = None
+        # change_seq of the last scan
+        self.scan_seq = 0
         super(ObjectFS, self).__init__(vInode, root=True)
 
+    def changed(self, paths):
+        """
+        Record changed absolute paths and wake up .watch readers
+        """
+        with self.lock:
+            for path in paths:
+                self.change_seq += 1
+                self.changes.append((self.change_seq, path))
+            self.wakeup()
+
+    def notify(self, target, *names):
+        """
+        Notify .watch readers, that the exported object
+        ``target`` or its attributes ``names`` are changed.
+        ``target`` can be also a path in the storage.
+        Return False, if the object is not exported.
+        """
+        with self.lock:
+            if isinstance(target, basestring):
+                prefix = target.rstrip("/")
+            else:
+                inode = self.exports.get(id(target))
+                if inode is None:
+                    return False
+                prefix = inode.absolute_path()
+            self.changed(["%s/%s" % (prefix, x) for x in names] or
+                         [prefix])
+        return True
+
+    def watch(self, inode):
+        """
+        Start scanning the directory of the ``.watch`` inode
+        """
+        if id(inode) in self.watching:
+            return
+        with self.lock:
+            self.watching[id(inode)] = (inode, _flatten(_tree(inode.parent)))
+            if self.watcher is None:
+                self.watcher = threading.Thread(
+                    target=_watcher,
+                    args=(weakref.ref(self), self.watch_interval),
+                    name="PyVFS watcher for ObjectFS at 0x%x" % (id(self)))
+                self.watcher.setDaemon(True)
+                self.watcher.start()
+
+    def scan(self):
+        """
+        Compare watched subtrees with their fingerprints, record
+        the changes. Directories are watched while there are
+        readers of their ``.watch``, and ``watch_timeout``
+        seconds after the last read.
+
+        The subtrees are dumped without the storage lock, so a
+        large watched subtree does not stall other clients.
+        """
+        with self.lock:
+            now = _clock()
+            watched = []
+            for (key, (inode, old)) in list(self.watching.items()):
+                if self.files.get(inode.path) is not inode or \
+                        (inode.deadline is None and
+                         now - inode.last_read > self.watch_timeout):
+                    del self.watching[key]
+                    continue
+                watched.append((key, inode, old))
+        trees = []
+        for (key, inode, old) in watched:
+            try:
+                trees.append((key, inode, old,
+                              _flatten(_tree(inode.parent))))
+            except Exception:
+                logging.debug("watched tree dump failed: %s" %
+                              (traceback.format_exc()))
+        with self.lock:
+            changes = []
+            # changes recorded since the last scan are known already
+            known = set([x[1] for x in self.changes if x[0] > self.scan_seq])
+            for (key, inode, old, new) in trees:
+                if key not in self.watching:
+                    continue
+                self.watching[key] = (inode, new)
+                if new == old:
+                    continue
+                prefix = inode.parent.absolute_path()
+                diff = set(new) ^ set(old)
+                diff.update([x for x in new if x in old and new[x] != old[x]])
+                changes.extend([prefix + x for x in sorted(diff)
+                                if prefix + x not in known])
+            if changes:
+                self.changed(changes)
+            elif self.waiters:
+                # deferred readers check their timeouts
+                self.wakeup()
+            self.scan_seq = self.change_seq
+
+    def track(self, inode, obj):
+        """
+        Queue the root ``inode`` for removal, when ``obj`` is
+        collected. The weakref callback can run in any thread,
+        in the middle of anything, so it only appends the inode
+        to the queue. Queued roots are removed in batches by the
+        reaper thread, or by the next listing of their parent,
+        whatever comes first.
+        """
+        dead = self.dead
+        inode.finalizer = weakref.ref(obj, lambda x: dead.append(inode))
+        if self.reaper is None:
+            self.reaper = threading.Thread(
+                target=_reaper,
+                args=(weakref.ref(self), self.reap_interval),
+                name="PyVFS reaper for ObjectFS at 0x%x" % (id(self)))
+            self.reaper.setDaemon(True)
+            self.reaper.start()
+
+    def reap(self):
+        """
+        Destroy all the queued roots
+        """
+        if not self.dead:
+            return
+        with self.lock:
+            while self.dead:
+                inode = self.dead.popleft()
+                if self.files.get(inode.path) is inode:
+                    inode.destroy()
+
     def mkdir(self, basedir):
         if isinstance(basedir, basestring):
             basedir = basedir.split('/')
@@ -685,11 +1882,64 @@ class ObjectFS(Storage):
         return parent
 
     def export_item(self, obj, config):
+        config = dict(config)
         self.create(parent=self.mkdir(config.get('basedir', '')),
                     obj=obj,
                     mode=config.pop('mode', 0),
                     **config)
 
+    def defer_export(self, obj, config):
+        """
+        Queue the object export, see ``export(deferred=True)``.
+        Objects are referenced weakly, if possible, so those
+        collected before the export are just skipped. If the
+        queue has ``export_limit`` items already, the object
+        is dropped.
+        """
+        try:
+            ref = weakref.ref(obj)
+        except TypeError:
+            def ref():
+                return obj
+        with self.export_lock:
+            if len(self.exports_pending) >= self.export_limit:
+                self.export_counters["dropped"] += 1
+                return
+            self.exports_pending.append((ref, config))
+            self.export_counters["queued"] += 1
+            if self.exporter is None:
+                self.exporter = threading.Thread(
+                    target=_exporter,
+                    args=(weakref.ref(self), self.export_event,
+                          self.export_delay),
+                    name="PyVFS exporter for ObjectFS at 0x%x" %
+                    (id(self)))
+                self.exporter.setDaemon(True)
+                self.exporter.start()
+        if not self.export_event.is_set():
+            self.export_event.set()
+
+    def flush_exports(self):
+        """
+        Export all the queued objects, ``export_batch`` of them
+        per the storage lock acquisition
+        """
+        while self.exports_pending:
+            with self.lock:
+                for i in range(self.export_batch):
+                    try:
+                        (ref, config) = self.exports_pending.popleft()
+                    except IndexError:
+                        break
+                    obj = ref()
+                    if obj is None:
+                        self.export_counters["expired"] += 1
+                        continue
+                    self.export_item(obj, config)
+                    self.export_counters["exported"] += 1
+                    del obj
+
+    @timed("create")
     def create(self, name=None, parent=None, mode=0, obj=None, **config):
         """
         Create an object inode and all the subtree. If ``parent``
@@ -717,6 +1967,7 @@ class ObjectFS(Storage):
             elif isinstance(name, basestring) \
                     and name \
                     and name[0] in ('@', '#'):
+                import uuid
                 config['name_template'] = name
                 name = str(uuid.uuid4())
 
@@ -751,11 +2002,80 @@ class ObjectFS(Storage):
         return new
 
 
+def _reaper(ref, interval):
+    """
+    The reaper thread: remove queued dead roots every
+    ``interval`` seconds. The thread stops with the storage.
+    """
+    while True:
+        time.sleep(interval)
+        storage = ref()
+        if storage is None:
+            return
+        if storage.dead:
+            try:
+                storage.reap()
+            except:
+                logging.error("reaper failed: %s" %
+                              (traceback.format_exc()))
+        del storage
+
+
+def _watcher(ref, interval):
+    """
+    The watcher thread: scan watched subtrees every
+    ``interval`` seconds. The thread stops with the storage.
+    """
+    while True:
+        time.sleep(interval)
+        storage = ref()
+        if storage is None:
+            return
+        if storage.watching:
+            try:
+                storage.scan()
+            except:
+                logging.error("watcher failed: %s" %
+                              (traceback.format_exc()))
+        del storage
+
+
+def _exporter(ref, event, delay):
+    """
+    The exporter thread: wait for deferred exports, collect
+    a batch for ``delay`` seconds and export it. The thread
+    stops with the storage.
+    """
+    while True:
+        if not event.wait(1):
+            if ref() is None:
+                return
+            continue
+        time.sleep(delay)
+        event.clear()
+        storage = ref()
+        if storage is None:
+            return
+        try:
+            storage.flush_exports()
+        except:
+            logging.error("exporter failed: %s" %
+                          (traceback.format_exc()))
+        del storage
+
+
 def export(*argv, **config):
     """
     The decorator, that is used to export functions to the filesystem.
 
     `config` has the same format as for MetaExport.
+
+    Decorated classes export every new instance from ``__init__()``.
+    With ``deferred=True``, instances are only queued there, and
+    exported in batches by a background thread, or by the next
+    listing of their parent directory. Instances collected before
+    that are never exported, and if the queue is full, new ones
+    are dropped, see ObjectFS.defer_export().
     """
     config = copy(config)
 
@@ -774,15 +2094,22 @@ def export(*argv, **config):
                     pass
                 old_init = fake_init
 
+            instance_config = dict(config, root=True, is_internal=True)
+            instance_filter = instance_config.get('filter', None)
+            if instance_config.pop('deferred', False):
+                export_instance = fs.defer_export
+            else:
+                export_instance = fs.export_item
+
             def new_init(self, *argv, **kwarg):
                 old_init(self, *argv, **kwarg)
-                if 'filter' in config and not config['filter'](self):
+                if instance_filter is not None and \
+                        not instance_filter(self):
                     return
 
-                config['root'] = True
-                config['is_internal'] = True
-                logging.debug('create object %s with config %s' % (self, config))
-                fs.export_item(self, config)
+                logging.debug('create object %s with config %s',
+                              self, instance_config)
+                export_instance(self, instance_config)
 
             c.__init__ = new_init
 
@@ -5,28 +5,97 @@ pyvfs.utils -- utility classes
 Utility classes for VFS
 """
 import os
+import sys
 import ast
+import stat
+import socket
+import time
 import logging
 import threading
+import traceback
 from collections import deque
 from pyvfs.vfs import Inode, Storage
 
-protocols = []
+# modules of protocol front-ends, those are imported only when
+# a Server is created, see available()
+requirements = {"9p": ("py9p.py9p", "pyvfs.v9fs"),
+                "fuse": ("fuse", "pyvfs.ffs")}
 
-try:
-    from py9p import py9p
-    from pyvfs.v9fs import v9fs
-    protocols.append("9p")
-except:
-    pass
+# the mode of UNIX sockets, if PYVFS_PORT is not a mode
+DEFAULT_SOCKET_MODE = 0o600
+
+
+def available(proto):
+    """
+    Import modules, that the protocol requires, return True if
+    the protocol can be used
+    """
+    try:
+        for module in requirements[proto]:
+            __import__(module)
+    except:
+        return False
+    return True
+
+
+def parse_address(address):
+    """
+    Parse the 9p listening address, return (family, address):
+
+    * ``unix:/path`` or ``/path`` -- UNIX socket path
+    * ``@name`` -- Linux abstract UNIX socket, no file
+    * anything else -- IPv4 address
 
+    ``{pid}`` in the address is replaced with the process id,
+    so every process can export its own storage, e.g.
+    ``@pyvfs-{pid}``.
+    """
+    address = address.replace("{pid}", str(os.getpid()))
+    if address.startswith("unix:"):
+        address = address[5:]
+    if address.startswith("/"):
+        return (socket.AF_UNIX, address)
+    if address.startswith("@"):
+        return (socket.AF_UNIX, "\0" + address[1:])
+    return (socket.AF_INET, address)
+
+
+def socket_mode(port):
+    """
+    With UNIX sockets PYVFS_PORT is the socket file mode, in
+    octal, like chmod(1) takes it: 660 means 0o660. A port,
+    that is not a valid mode, like the default one, gives
+    DEFAULT_SOCKET_MODE.
+    """
+    try:
+        mode = int(str(port), 8)
+    except ValueError:
+        return DEFAULT_SOCKET_MODE
+    return mode if mode <= 0o777 else DEFAULT_SOCKET_MODE
 
-try:
-    import fuse
-    from pyvfs.ffs import ffs
-    protocols.append("fuse")
-except:
-    pass
+
+def listen9p(address, port=10001, **kwarg):
+    """
+    Return py9p.Server listening on the address, see
+    parse_address(); ``kwarg`` are passed to py9p.Server
+    """
+    from py9p import py9p
+    (family, address) = parse_address(address)
+    if family == socket.AF_INET:
+        return py9p.Server(listen=(address, port), **kwarg)
+    if address.startswith("/"):
+        return py9p.Server(listen=(address, socket_mode(port)), **kwarg)
+    # py9p binds only TCP and path sockets, so replace the
+    # listening socket with the abstract one
+    srv = py9p.Server(listen=("127.0.0.1", 0), **kwarg)
+    srv.readpool.remove(srv.sock)
+    srv.sock.close()
+    srv.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    srv.sock.bind(address)
+    srv.sock.listen(5)
+    srv.host = address
+    srv.readpool.append(srv.sock)
+    return srv
 
 
 class logInode(Inode):
@@ -74,6 +143,221 @@ class indexInode(Inode):
                 i, oct(k.mode), k.absolute_path()))
 
 
+class statsInode(Inode):
+    """
+    Storage performance counters summary, see pyvfs.vfs.Stats.
+    Times are in seconds. Write anything to the file to reset
+    the counters.
+    """
+    def sync(self, data):
+        self.seek(0)
+        self.truncate()
+        self.write(("%-16s %10s %12s %12s %12s\n" % (
+            "# op", "count", "total", "avg", "max")).encode('utf-8'))
+        if self.storage.stats is None:
+            return
+        for (op, x) in sorted(self.storage.stats.snapshot().items()):
+            self.write(("%-16s %10i %12.6f %12.6f %12.6f\n" % (
+                op, x["count"], x["total"], x["total"] / x["count"],
+                x["max"])).encode('utf-8'))
+
+    def commit(self, data):
+        if self.storage.stats is not None:
+            self.storage.stats.reset()
+
+
+class histogramInode(Inode):
+    """
+    Storage latency histograms, see pyvfs.vfs.Stats. Every
+    line lists non-empty buckets of an operation as
+    ``<bound:count``, the bound is in microseconds.
+    """
+    def sync(self, data):
+        self.seek(0)
+        self.truncate()
+        if self.storage.stats is None:
+            return
+        for (op, x) in sorted(self.storage.stats.snapshot().items()):
+            buckets = ["<%i:%i" % (2 ** i, k) for (i, k)
+                       in enumerate(x["histogram"]) if k]
+            if x["histogram"][-1]:
+                buckets[-1] = ">=%i:%i" % (2 ** (len(x["histogram"]) - 2),
+                                           x["histogram"][-1])
+            self.write(("%-16s %s\n" % (op, " ".join(buckets)))
+                       .encode('utf-8'))
+
+
+class hooksInode(Inode):
+    """
+    Per inode hook costs, the most expensive first, see
+    pyvfs.vfs.Storage.hook(). Times are in seconds.
+    """
+    def sync(self, data):
+        self.seek(0)
+        self.truncate()
+        self.write(("%10s %12s %12s  %s\n" % (
+            "# count", "total", "max", "path")).encode('utf-8'))
+        for (path, count, total, top) in self.storage.hook_report():
+            self.write(("%10i %12.6f %12.6f  %s\n" % (
+                count, total, top, path)).encode('utf-8'))
+
+
+class exportsInode(Inode):
+    """
+    Deferred export counters, see
+    pyvfs.objectfs.ObjectFS.defer_export()
+    """
+    def sync(self, data):
+        self.seek(0)
+        self.truncate()
+        counters = getattr(self.storage, "export_counters", {})
+        for (name, value) in sorted(counters.items()):
+            self.write(("%-16s %10i\n" % (name, value)).encode('utf-8'))
+        if hasattr(self.storage, "exports_pending"):
+            self.write(("%-16s %10i\n" % (
+                "pending", len(self.storage.exports_pending)))
+                .encode('utf-8'))
+
+
+class Profiler(threading.Thread):
+    """
+    Sampling profiler. Every ``interval`` seconds, while
+    enabled, takes stacks of all the threads and counts those,
+    that run pyvfs code: protocol handlers, storage operations,
+    inode hooks. The result is in the collapsed stack format,
+    one ``frame;frame;...;frame count`` line per stack, as
+    used by flamegraph tools.
+
+    Idle threads, that only wait in the server loop, are not
+    counted, as well as ObjectFS background threads, while they
+    wait in their loops, see ``idle_loops``.
+    """
+    # background thread loops: samples, where the innermost
+    # pyvfs frame is one of them, are idle
+    idle_loops = frozenset(("_reaper", "_watcher", "_exporter"))
+
+    def __init__(self, interval=0.005):
+        threading.Thread.__init__(self, name="PyVFS profiler")
+        self.setDaemon(True)
+        self.interval = interval
+        self.samples = 0
+        self.stacks = {}
+        self.lock = threading.Lock()
+        self.active = threading.Event()
+        self.prefix = os.path.dirname(os.path.abspath(__file__))
+        self.idle = os.path.splitext(os.path.abspath(__file__))[0]
+        self.labels = {}
+
+    def enable(self):
+        self.active.set()
+        if not self.is_alive():
+            self.start()
+
+    def disable(self):
+        self.active.clear()
+
+    def reset(self):
+        with self.lock:
+            self.samples = 0
+            self.stacks = {}
+
+    def label(self, code):
+        try:
+            return self.labels[code]
+        except KeyError:
+            name = code.co_filename
+            if name.startswith(self.prefix):
+                name = "pyvfs/%s" % (name[len(self.prefix) + 1:])
+            label = self.labels[code] = "%s (%s:%i)" % (
+                code.co_name, name, code.co_firstlineno)
+            return label
+
+    def sample(self):
+        own = threading.current_thread().ident
+        frames = sys._current_frames()
+        with self.lock:
+            self.samples += 1
+            for (ident, frame) in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                busy = False
+                inner = None
+                while frame is not None:
+                    code = frame.f_code
+                    if code.co_filename.startswith(self.prefix):
+                        if inner is None:
+                            inner = code
+                        if not code.co_filename.startswith(self.idle):
+                            busy = True
+                    stack.append(self.label(code))
+                    frame = frame.f_back
+                if inner is not None and inner.co_name in self.idle_loops:
+                    busy = False
+                if busy:
+                    key = ";".join(reversed(stack))
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+        del frames
+
+    def collapsed(self):
+        with self.lock:
+            return sorted(self.stacks.items(), key=lambda x: x[1],
+                          reverse=True)
+
+    def run(self):
+        while True:
+            self.active.wait()
+            self.sample()
+            time.sleep(self.interval)
+
+
+class profileControlInode(Inode):
+    """
+    Profiler control file: shows the profiler state and
+    accepts ``on``, ``off`` and ``reset`` commands.
+    """
+    def __init__(self, name, parent, profiler):
+        Inode.__init__(self, name, parent)
+        self.profiler = profiler
+
+    def sync(self, data):
+        self.seek(0)
+        self.truncate()
+        self.write(("%s\ninterval: %s\nsamples: %i\n" % (
+            "on" if self.profiler.active.is_set() else "off",
+            self.profiler.interval,
+            self.profiler.samples)).encode('utf-8'))
+
+    def commit(self, data):
+        # only the first line: a write without O_TRUNC leaves
+        # the rest of the status text in the buffer
+        lines = self.getvalue().decode('utf-8').strip().splitlines()
+        command = lines[0].strip().lower() if lines else ""
+        if command == "on":
+            self.profiler.enable()
+        elif command == "off":
+            self.profiler.disable()
+        elif command == "reset":
+            self.profiler.reset()
+        else:
+            logging.warning("unknown profiler command: %s" % (command))
+
+
+class profileStacksInode(Inode):
+    """
+    Collapsed stacks, collected by the profiler.
+    """
+    def __init__(self, name, parent, profiler):
+        Inode.__init__(self, name, parent)
+        self.profiler = profiler
+
+    def sync(self, data):
+        self.seek(0)
+        self.truncate()
+        for (stack, count) in self.profiler.collapsed():
+            self.write(("%s %i\n" % (stack, count)).encode('utf-8'))
+
+
 class Server(threading.Thread):
     """
     The main interface to create and start a filesystem.
@@ -91,19 +375,50 @@ class Server(threading.Thread):
     immediately with the script startup. You can configure
     the behaviour with environment variables:
 
-     * **PYVFS_PROTO** -- ``9p`` (default) or ``fuse``
-     * **PYVFS_PORT** -- tcp port for TCP sockets and access mode
-       for UNIX sockets (9p only, default: 10001)
+     * **PYVFS_PROTO** -- ``9p`` (default) or ``fuse``, or a comma
+       separated list, e.g. ``9p,fuse``, to serve the storage with
+       several protocols at once, every one in its own thread
+     * **PYVFS_PORT** -- tcp port for TCP sockets and octal access
+       mode for UNIX sockets, e.g. 660 (9p only, default: 10001,
+       and 600 for UNIX sockets)
      * **PYVFS_ADDRESS** -- IPv4 address, use 0.0.0.0 to allow
-       public access (9p only, default: 127.0.0.1)
+       public access; ``unix:/path`` or ``/path`` for a UNIX socket,
+       ``@name`` for an abstract UNIX socket; ``{pid}`` is replaced
+       with the process id, see ``parse_address()``
+       (9p only, default: 127.0.0.1)
      * **PYVFS_MOUNTPOINT** -- the mountpoint (fuse only, default: ./mnt)
      * **PYVFS_DEBUG** -- turn on stderr debug output of the FS protocol
      * **PYVFS_LOG** -- create /log inode
+     * **PYVFS_LOG_SAMPLE** -- with PYVFS_LOG, check callers of
+       restricted inode methods only on every Nth call (default: 1)
+     * **PYVFS_STATS** -- record performance counters and create
+       /.stats/summary, /.stats/histogram and /.stats/hooks inodes,
+       and /.stats/exports for ObjectFS (default: True)
+     * **PYVFS_PROFILE** -- create /.profile/control and
+       /.profile/stacks inodes of the sampling profiler, see
+       ``Profiler``; write ``on`` to the control file to start
+       sampling (default: False)
+     * **PYVFS_PROFILE_INTERVAL** -- profiler sampling interval,
+       seconds (default: 0.005)
+     * **PYVFS_SLOW_HOOK** -- log inode hooks running longer than
+       this, in seconds; 0 to disable (default: 0.1)
      * **PYVFS_ALLOW_ROOT** -- allow root to access the mountpoint (fuse
        only, default: False)
      * **PYVFS_ALLOW_OTHER** -- allow other users to access the
        mountpoint, requires ``user_allow_other`` in ``/etc/fuse.conf``
        (fuse only, default: False)
+     * **PYVFS_MULTITHREADED** -- serve FUSE requests in parallel
+       threads; blocking reads, like ``.watch`` files, need it
+       (fuse only, default: True)
+     * **PYVFS_KEEP_CACHE** -- let the kernel keep cached data of
+       static files between opens (fuse only, default: True)
+     * **PYVFS_DIRECT_IO** -- bypass the kernel page cache for
+       files, that generate data on read, like exported object
+       attributes (fuse only, default: True)
+     * **PYVFS_ATTR_TIMEOUT** -- seconds the kernel caches file
+       attributes (fuse only, default: 1.0)
+     * **PYVFS_ENTRY_TIMEOUT** -- seconds the kernel caches name
+       lookups (fuse only, default: 1.0)
      * **AUTHMODE** -- authentication mode for 9p, can be ``pki``
        (9p only, default: none)
      * **KEYFILES** -- map of user public key files
@@ -140,8 +455,17 @@ class Server(threading.Thread):
               "mountpoint": "./mnt",
               "debug": False,
               "log": False,
+              "stats": True,
+              "slow_hook": 0.1,
+              "profile": False,
+              "profile_interval": 0.005,
               "allow_root": False,
               "allow_other": False,
+              "multithreaded": True,
+              "keep_cache": True,
+              "direct_io": True,
+              "attr_timeout": 1.0,
+              "entry_timeout": 1.0,
               "authmode": "",
               "keyfiles": {}}
 
@@ -162,12 +486,12 @@ class Server(threading.Thread):
             setattr(self, i, value)
         if self.authmode == "":
             self.authmode = None
-        for i in list(self.protocols.keys()):
-            if i not in protocols:
-                del self.protocols[i]
-        if self.proto not in self.protocols:
-            raise Exception("Requested protocol <%s> is not available" %
-                            (self.proto))
+        self.protos = [x.strip() for x in self.proto.split(",")
+                       if x.strip()]
+        for proto in self.protos:
+            if proto not in self.protocols or not available(proto):
+                raise Exception("Requested protocol <%s> is not available" %
+                                (proto))
         if self.log:
             indexInode("index", self.fs.root)
             log = logInode("log", self.fs.root, maxlen=1024)
@@ -182,20 +506,75 @@ class Server(threading.Thread):
             for i in range(len(logger.handlers) - 1):
                 logger.removeHandler(logger.handlers[0])
             logger.debug("PyVFS started")
-
-        self.run = self.protocols[self.proto](self)
+        if self.stats:
+            stats = Inode(".stats", self.fs.root, mode=stat.S_IFDIR)
+            statsInode("summary", stats)
+            histogramInode("histogram", stats)
+            hooksInode("hooks", stats)
+            if hasattr(self.fs, "export_counters"):
+                exportsInode("exports", stats)
+        else:
+            self.fs.stats = None
+        self.fs.slow_hook = self.slow_hook if self.slow_hook > 0 else None
+        if self.profile:
+            self.profiler = Profiler(self.profile_interval)
+            profile = Inode(".profile", self.fs.root, mode=stat.S_IFDIR)
+            profileControlInode("control", profile, self.profiler)
+            profileStacksInode("stacks", profile, self.profiler)
+        else:
+            self.profiler = None
+
+        # front-ends share the storage with its locks and stats
+        self.frontends = [(x, self.protocols[x](self)) for x in self.protos]
+        if len(self.frontends) == 1:
+            self.run = self.frontends[0][1]
+        else:
+            self.run = self.serve
+
+    def serve(self):
+        """
+        Run every front-end but the first one in a separate
+        daemon thread, and the first one in this thread
+        """
+        for (proto, run) in self.frontends[1:]:
+            thread = threading.Thread(target=self.frontend,
+                                      args=(proto, run),
+                                      name="PyVFS %s for storage at 0x%x" %
+                                      (proto, id(self.fs)))
+            thread.setDaemon(True)
+            thread.start()
+        self.frontend(*self.frontends[0])
+
+    def frontend(self, proto, run):
+        try:
+            run()
+        except:
+            logging.error("%s front-end failed: %s" %
+                          (proto, traceback.format_exc()))
 
     def mount_v9fs(self):
-        srv = py9p.Server(listen=(self.address, self.port),
-                          authmode=self.authmode, key=self.keyfiles,
-                          chatty=self.debug, dotu=True)
+        from pyvfs.v9fs import v9fs
+        srv = listen9p(self.address, self.port,
+                       authmode=self.authmode, key=self.keyfiles,
+                       chatty=self.debug, dotu=True)
         srv.mount(v9fs(self.fs))
         return srv.serve
 
     def mount_fuse(self):
+        import fuse
+        from pyvfs.ffs import ffs
         srv = ffs(storage=self.fs, version="%prog " + fuse.__version__,
                   dash_s_do='undef')
         srv.fuse_args.setmod('foreground')
+        srv.multithreaded = self.multithreaded
+        srv.keep_cache = self.keep_cache
+        srv.direct_io = self.direct_io
+        # the high-level API has no per-inode timeouts
+        srv.fuse_args.add('attr_timeout=%s' % (self.attr_timeout))
+        srv.fuse_args.add('entry_timeout=%s' % (self.entry_timeout))
+        # O_TRUNC with open(), not as a separate truncate(),
+        # see ffs.truncate()
+        srv.fuse_args.add('atomic_o_trunc')
         if self.debug:
             srv.fuse_args.add('debug')
         if self.allow_root:
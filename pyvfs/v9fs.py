@@ -4,9 +4,11 @@ pyvfs.v9fs -- 9pfs connector
 
 9p2000 abstraction layer, is used to plug VFS into py9p
 """
+import os
 import stat
 import logging
 from py9p import py9p
+from pyvfs.vfs import timed
 
 try:
     assert hasattr(py9p, "DMSTICKY")
@@ -35,7 +37,7 @@ def inode2dir(inode):
                     uid=bytes(inode.uid.encode('utf-8')),
                     gid=bytes(inode.gid.encode('utf-8')),
                     muid=bytes(inode.muid.encode('utf-8')),
-                    extension=inode.getvalue() if
+                    extension=inode.readlink() if
                     inode.mode == stat.S_IFLNK else b'',
                     uidnum=inode.uidnum,
                     gidnum=inode.gidnum,
@@ -68,8 +70,39 @@ class v9fs(py9p.Server):
     def __init__(self, storage):
         self.mountpoint = b'/'
         self.storage = storage
+        self.stats = storage.stats
         self.root = inode2dir(self.storage.root)
-
+        # deferred reads of blocking inodes: req -> (rfd, wfd)
+        self.deferred = {}
+
+    def ready(self, srv, req, inode):
+        """
+        The server loop must not block, so the reads of blocking
+        inodes, that are not ready, are deferred: a pipe is
+        registered in the server read pool, and the storage
+        wakes it up, when the inode is ready. Then the server
+        repeats the read.
+        """
+        pipe = self.deferred.pop(req, None)
+        if pipe is not None:
+            os.close(pipe[0])
+            os.close(pipe[1])
+        if inode.pending() <= 0:
+            return True
+        (rfd, wfd) = os.pipe()
+
+        def waiter():
+            if inode.pending() > 0:
+                return True
+            os.write(wfd, b"\0")
+            return False
+
+        self.deferred[req] = (rfd, wfd)
+        srv.regreadfd(rfd, req)
+        self.storage.waiters.append(waiter)
+        return False
+
+    @timed("9p.create")
     @checkout
     def create(self, srv, req, inode):
         new = self.storage.create(req.ifcall.name, inode,
@@ -80,6 +113,7 @@ class v9fs(py9p.Server):
                                   new.path)
         srv.respond(req, None)
 
+    @timed("9p.open")
     @checkout
     def open(self, srv, req, inode):
         if req.ifcall.mode & py9p.OTRUNC:
@@ -88,6 +122,7 @@ class v9fs(py9p.Server):
             self.storage.open(inode)
         srv.respond(req, None)
 
+    @timed("9p.walk")
     def walk(self, srv, req, fid=None):
 
         fd = fid or req.fid
@@ -109,6 +144,7 @@ class v9fs(py9p.Server):
         srv.respond(req, "file not found")
         return
 
+    @timed("9p.wstat")
     @checkout
     def wstat(self, srv, req, inode):
 
@@ -126,6 +162,7 @@ class v9fs(py9p.Server):
             inode.parent.rename(inode.name, istat.name.decode('utf-8'))
         srv.respond(req, None)
 
+    @timed("9p.stat")
     @checkout
     def stat(self, srv, req, inode):
         self.storage.sync(inode)
@@ -133,6 +170,7 @@ class v9fs(py9p.Server):
         req.ofcall.stat.append(p9dir)
         srv.respond(req, None)
 
+    @timed("9p.write")
     @checkout
     def write(self, srv, req, inode):
         req.ofcall.count = self.storage.write(inode,
@@ -140,6 +178,7 @@ class v9fs(py9p.Server):
                                               req.ifcall.offset)
         srv.respond(req, None)
 
+    @timed("9p.clunk")
     @checkout
     def clunk(self, srv, req, inode):
         try:
@@ -148,26 +187,35 @@ class v9fs(py9p.Server):
             pass
         srv.respond(req, None)
 
+    @timed("9p.remove")
     @checkout
     def remove(self, srv, req, inode):
         self.storage.remove(inode)
         srv.respond(req, None)
 
+    @timed("9p.read")
     @checkout
     def read(self, srv, req, inode):
 
-        if req.ifcall.offset == 0:
-            self.storage.sync(inode)
-
         if py9p.mode2plan(inode.mode) & py9p.DMDIR:
+            if req.ifcall.offset == 0:
+                self.storage.sync(inode)
             req.ofcall.stat = []
             for (i, k) in list(inode.children.items()):
                 if i not in (".", ".."):
                     self.storage.sync(k)
                     req.ofcall.stat.append(inode2dir(k))
         else:
-            req.ofcall.data = self.storage.read(inode, req.ifcall.count,
-                                                req.ifcall.offset)
+            # storage.read() syncs the file at offset 0
+            if req.ifcall.offset == 0 and inode.blocking and \
+                    not self.ready(srv, req, inode):
+                return
+            data = self.storage.read(inode, req.ifcall.count,
+                                     req.ifcall.offset)
+            # MappedInode data: copy only the reply chunk
+            if isinstance(data, memoryview):
+                data = data.tobytes()
+            req.ofcall.data = data
             req.ofcall.count = len(req.ofcall.data)
 
         srv.respond(req, None)
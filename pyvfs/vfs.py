@@ -7,18 +7,22 @@ filesystems.
 """
 
 import os
+import sys
+import mmap
 import stat
 import time
 import pwd
 import grp
 import threading
 import logging
-import inspect
+import itertools
 import traceback
 from io import BytesIO
 
 DEFAULT_DIR_MODE = 0o755
 DEFAULT_FILE_MODE = 0o644
+# number of inode I/O buffer locks, see Storage.io_lock()
+IO_LOCKS = 64
 
 
 class Eperm(Exception):
@@ -35,21 +39,116 @@ class Edebug(Exception):
     pass
 
 
+if hasattr(time, "perf_counter"):
+    _clock = time.perf_counter
+else:
+    _clock = time.time
+
+
+class Stats(object):
+    """
+    Operation counters and latency histograms. Every operation
+    has a count, total and max time (in seconds) and a histogram
+    with power of 2 buckets in microseconds: the bucket N counts
+    operations that took less than 2**N us, the last bucket
+    counts all the slower ones.
+
+    The storage records its own operations under plain names,
+    like ``read`` or ``sync``; front-ends use prefixed names,
+    like ``9p.walk`` or ``fuse.getattr``.
+    """
+    buckets = 24
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # op -> [count, total, max, histogram]
+        self.ops = {}
+
+    def record(self, op, elapsed):
+        bucket = min(int(elapsed * 1000000).bit_length(), self.buckets - 1)
+        with self.lock:
+            try:
+                entry = self.ops[op]
+            except KeyError:
+                entry = self.ops[op] = [0, 0.0, 0.0, [0] * self.buckets]
+            entry[0] += 1
+            entry[1] += elapsed
+            if elapsed > entry[2]:
+                entry[2] = elapsed
+            entry[3][bucket] += 1
+
+    def snapshot(self):
+        """
+        Return a copy of the counters as a dictionary::
+
+            {op: {"count": ..., "total": ..., "max": ...,
+                  "histogram": [...]}}
+        """
+        with self.lock:
+            return dict([(op, {"count": x[0],
+                               "total": x[1],
+                               "max": x[2],
+                               "histogram": list(x[3])})
+                         for (op, x) in self.ops.items()])
+
+    def reset(self):
+        with self.lock:
+            self.ops = {}
+
+
+def timed(op):
+    """
+    Record the method run time in ``self.stats`` as ``op``.
+    Recording is skipped, if ``self.stats`` is None.
+    """
+    def decorator(c):
+        def wrapped(self, *argv, **kwarg):
+            stats = self.stats
+            if stats is None:
+                return c(self, *argv, **kwarg)
+            start = _clock()
+            try:
+                return c(self, *argv, **kwarg)
+            finally:
+                stats.record(op, _clock() - start)
+        wrapped.__name__ = c.__name__
+        wrapped.__doc__ = c.__doc__
+        return wrapped
+    return decorator
+
+
+# Inode subclass -> does it use the default no-op sync()
+_static_classes = {}
+
+# caller code object -> is it a Storage or Inode method
+_restrict_callers = {}
+# check only every Nth call of restricted methods, see
+# PYVFS_LOG_SAMPLE below
+_restrict_sample = 1
+_restrict_counter = itertools.count()
+
+
 def _restrict_debug(c):
     def wrapped(*argv, **kwarg):
-        stack = inspect.stack()
-        try:
-            caller = stack[1][0].f_locals['self']
-            line = stack[1][0].f_code.co_firstlineno
-            assert isinstance(caller, Storage) or\
-                isinstance(caller, Inode)
-        except AssertionError:
-            logging.warning("Inode method %s called from: %s:%s" %
-                            (c, caller, line))
-        except:
-            logging.error("Got error while analyzing stack: %s" %
-                          (traceback.format_exc()))
+        if next(_restrict_counter) % _restrict_sample == 0:
+            try:
+                frame = sys._getframe(1)
+                code = frame.f_code
+                legal = _restrict_callers.get(code)
+                if legal is None:
+                    caller = frame.f_locals.get('self')
+                    legal = _restrict_callers[code] = \
+                        isinstance(caller, (Storage, Inode))
+                if not legal:
+                    logging.warning("Inode method %s called from: %s:%s" %
+                                    (c, code.co_filename, frame.f_lineno))
+                del frame
+            except:
+                logging.error("Got error while analyzing stack: %s" %
+                              (traceback.format_exc()))
         return c(*argv, **kwarg)
+    wrapped.__name__ = c.__name__
+    wrapped.__doc__ = c.__doc__
     return wrapped
 
 
@@ -60,6 +159,11 @@ def _restrict_bypass(c):
 if os.environ.get("PYVFS_LOG", "False").lower() in (
         "yes", "true", "on", "t", "1"):
     restrict = _restrict_debug
+    try:
+        _restrict_sample = max(int(os.environ.get("PYVFS_LOG_SAMPLE",
+                                                  "1")), 1)
+    except ValueError:
+        logging.warning("bad PYVFS_LOG_SAMPLE value, using 1")
 else:
     restrict = _restrict_bypass
 
@@ -70,6 +174,12 @@ class Inode(BytesIO, object):
     """
     mode = 0
     cleanup = None
+    # reads at offset 0 wait for pending(), see Storage.wait()
+    blocking = False
+    # FUSE page cache policy: "keep" -- keep the cached data
+    # between opens, "direct" -- bypass the cache, None -- "keep"
+    # for static inodes, "direct" for others; see ffs.open()
+    cache = None
     # static member for special names
     special_names = [".",
                      ".."]
@@ -116,13 +226,18 @@ class Inode(BytesIO, object):
     def _update_register(self):
         if self.orphaned:
             return
+        # hook costs survive renames: unregister() drops them
+        cost = None
         try:
             self._check_special(self.name)
+            cost = self.storage.hook_costs.get(self.path)
             self.storage.unregister(self)
         except:
             pass
         self.path = int(abs(hash(self.absolute_path())))
         self.storage.register(self)
+        if cost is not None:
+            self.storage.hook_costs[self.path] = cost
         self.cleanup["storage"] = (self.storage.destroy, (self,))
         for (i, k) in [x for x in list(self.children.items())
                        if x[0] not in (".", "..")]:
@@ -186,6 +301,13 @@ class Inode(BytesIO, object):
     def open(self, data):
         pass
 
+    def pending(self):
+        """
+        For blocking inodes: return 0, if the inode is ready to
+        be read, otherwise the max number of seconds to wait
+        """
+        return 0
+
     @restrict
     def destroy(self):
         ret = {}
@@ -205,6 +327,12 @@ class Inode(BytesIO, object):
         logging.debug("destroy returned: %s" % (ret))
         return ret
 
+    def readlink(self):
+        """
+        Return the symlink target path
+        """
+        return self.getvalue()
+
     @restrict
     def add(self, inode):
         if inode.name in self.children:
@@ -247,9 +375,167 @@ class Inode(BytesIO, object):
     @property
     def length(self):
         if self.mode & stat.S_IFDIR:
-            return len(list(self.children.keys()))
+            return len(self.children)
         else:
-            return self.seek(0, 2)
+            with self.storage.io_lock(self):
+                return self.seek(0, 2)
+
+    @property
+    def static(self):
+        """
+        True, if sync() does nothing: the class does not
+        override it, and there is no on_sync hook
+        """
+        if self.on_sync is not None:
+            return False
+        klass = type(self)
+        try:
+            return _static_classes[klass]
+        except KeyError:
+            owner = [x for x in klass.__mro__ if "sync" in x.__dict__][0]
+            ret = _static_classes[klass] = owner is Inode
+            return ret
+
+
+class MappedInode(Inode):
+    """
+    File inode, that keeps the data out of the Python heap: in
+    an ``mmap`` of a backing file, or in an existing object,
+    that supports the buffer protocol, like ``bytearray``,
+    ``mmap`` or numpy arrays. ``source`` is the file path or the
+    object::
+
+        MappedInode("weights", parent, source="/var/lib/model.bin")
+        MappedInode("frame", parent, source=frame_buffer)
+
+    ``read()`` returns memoryview slices of the data, without
+    copies, so even multi-GB files take constant heap. The slice
+    shows the data as it is, a front-end should send or copy it
+    right away. Writes within the data are done in place. Only
+    file-backed inodes can change the size: the file is
+    truncated and mapped again.
+
+    The inode is read-only, unless ``writable=True``, whatever
+    the source: files are mapped read-only, and writes raise
+    Eperm. With ``writable=True`` a file is opened for writing,
+    and a buffer is written in place, if it is writable itself,
+    like ``bytearray``; read-only buffers, like ``bytes``, stay
+    read-only.
+
+    The map is closed, and the file too, when the inode is
+    destroyed.
+    """
+    def __init__(self, name, parent=None, mode=0, storage=None,
+                 source=None, writable=False, **kwarg):
+        Inode.__init__(self, name, parent, mode, storage, **kwarg)
+        self.position = 0
+        self.buffer = None
+        self.file = None
+        if isinstance(source, (str, type(u""))):
+            self.readonly = not writable
+            self.file = open(source, "rb" if self.readonly else "r+b")
+            self.remap(os.fstat(self.file.fileno()).st_size)
+        else:
+            self.buffer = memoryview(source)
+            if hasattr(self.buffer, "cast") and \
+                    (self.buffer.format != "B" or self.buffer.ndim != 1):
+                # byte offsets for typed and multi-dimensional data
+                self.buffer = self.buffer.cast("B")
+            self.readonly = not writable or self.buffer.readonly
+        if self.readonly:
+            self.mode &= ~0o222
+        self.cleanup["map"] = (self.unmap, )
+
+    @property
+    def size(self):
+        return 0 if self.buffer is None else len(self.buffer)
+
+    def close_map(self):
+        # views, returned by read(), keep the map alive till
+        # they are released
+        if self.buffer is not None:
+            try:
+                if self.file is not None:
+                    self.buffer.close()
+                elif hasattr(self.buffer, "release"):
+                    self.buffer.release()
+            except BufferError:
+                pass
+            self.buffer = None
+
+    def remap(self, size):
+        """
+        Truncate or extend the backing file and map it again
+        """
+        self.close_map()
+        if size != os.fstat(self.file.fileno()).st_size:
+            self.file.truncate(size)
+        # an empty file can not be mapped
+        if size:
+            self.buffer = mmap.mmap(self.file.fileno(), size,
+                                    access=mmap.ACCESS_READ
+                                    if self.readonly else mmap.ACCESS_WRITE)
+
+    def unmap(self):
+        self.close_map()
+        if self.file is not None:
+            self.file.close()
+
+    def view(self, start, stop):
+        if start >= stop:
+            return b""
+        try:
+            return memoryview(self.buffer)[start:stop]
+        except TypeError:
+            # no buffer protocol for mmap in Python 2: a copy
+            return self.buffer[start:stop]
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        start = min(self.position, self.size)
+        stop = self.size if size < 0 else min(start + size, self.size)
+        self.position = stop
+        return self.view(start, stop)
+
+    def write(self, data):
+        if self.readonly:
+            raise Eperm()
+        stop = self.position + len(data)
+        if stop > self.size:
+            if self.file is None:
+                raise Eperm()
+            self.remap(stop)
+        self.buffer[self.position:stop] = data
+        self.position = stop
+        return len(data)
+
+    def truncate(self, size=None):
+        if size is None:
+            size = self.position
+        if size != self.size:
+            if self.readonly or self.file is None:
+                raise Eperm()
+            self.remap(size)
+        return size
+
+    def getvalue(self):
+        data = self.view(0, self.size)
+        return data.tobytes() if isinstance(data, memoryview) else data
+
+    @restrict
+    def commit(self, data):
+        if self.file is not None and self.buffer is not None:
+            self.buffer.flush()
 
 
 class Storage(object):
@@ -263,6 +549,19 @@ class Storage(object):
     def __init__(self, inode=Inode, **kwarg):
         self.files = {}
         self.lock = threading.RLock()
+        # performance counters, set to None to disable
+        self.stats = Stats()
+        # inode.path -> [count, total, max] of hook runs
+        self.hook_costs = {}
+        # log hooks running longer, seconds; None to disable
+        self.slow_hook = 0.1
+        # inode I/O buffer locks, see io_lock()
+        self.io_locks = [threading.RLock() for i in range(IO_LOCKS)]
+        # blocking inodes readiness: notified by wakeup()
+        self.ready = threading.Condition(self.lock)
+        # callables, run by wakeup(); those returning False
+        # are removed
+        self.waiters = []
         self.root = inode(name="/", mode=stat.S_IFDIR, storage=self,
                           **kwarg)
 
@@ -277,7 +576,59 @@ class Storage(object):
         Remove an inode from the dictionary
         """
         del self.files[inode.path]
+        self.hook_costs.pop(inode.path, None)
 
+    def hook(self, inode, name):
+        """
+        Run the inode hook ``name`` (``on_open``, ``on_sync``,
+        ``on_commit`` or ``on_destroy``). Return (proceed, data):
+        the operation should be aborted, if the hook exists, but
+        failed or returned None.
+
+        Every hook run is timed: recorded in ``stats`` as
+        ``hook.<name>``, aggregated per inode in ``hook_costs``
+        and logged as a warning, if it took more than
+        ``slow_hook`` seconds.
+        """
+        hook = getattr(inode, name)
+        if hook is None:
+            return (True, None)
+        hook_data = None
+        start = _clock()
+        try:
+            hook_data = hook(inode)
+        except Exception:
+            logging.error('%s hook failed: %s\n%s' %
+                          (name, inode, traceback.format_exc()))
+        elapsed = _clock() - start
+        if self.stats is not None:
+            self.stats.record("hook.%s" % (name), elapsed)
+            try:
+                cost = self.hook_costs[inode.path]
+            except KeyError:
+                cost = self.hook_costs[inode.path] = [0, 0.0, 0.0]
+            cost[0] += 1
+            cost[1] += elapsed
+            if elapsed > cost[2]:
+                cost[2] = elapsed
+        if self.slow_hook is not None and elapsed > self.slow_hook:
+            logging.warning('slow %s hook: %s took %.6fs' %
+                            (name, inode.absolute_path() or "/", elapsed))
+        return (hook_data is not None, hook_data)
+
+    def hook_report(self, limit=None):
+        """
+        Return per inode hook costs, the most expensive first:
+        [(path, count, total, max), ...]
+        """
+        with self.lock:
+            report = [(self.files[i].absolute_path() or "/",) + tuple(x)
+                      for (i, x) in list(self.hook_costs.items())
+                      if i in self.files]
+        report.sort(key=lambda x: x[2], reverse=True)
+        return report[:limit]
+
+    @timed("create")
     def create(self, name, parent, mode=0):
         """
         Create an inode
@@ -290,6 +641,17 @@ class Storage(object):
     def checkout(self, target):
         return self.files[target]
 
+    def io_lock(self, inode):
+        """
+        The lock of the inode I/O buffer, one of ``IO_LOCKS``
+        striped by the inode path. Operations, that change the
+        buffer, take it with the storage lock, so reads at
+        offset > 0 need only this one, and do not wait for
+        syncs, hooks and other operations on other inodes.
+        """
+        return self.io_locks[inode.path % IO_LOCKS]
+
+    @timed("rename")
     def reparent(self, new_parent, inode, new_name=None):
         with self.lock:
             lookup = new_name or inode.name
@@ -300,92 +662,130 @@ class Storage(object):
                 inode.name = new_name
             new_parent.add(inode)
 
+    @timed("truncate")
     def truncate(self, inode, size=0):
+        """
+        Truncate or extend the file with zeros. Like writes, the
+        change is applied to the object by ``commit()`` only, so
+        a truncate followed by writes is committed once
+        """
         with self.lock:
-            inode.seek(size)
-            inode.truncate()
-            inode.commit(None)
+            inode.writelock = True
+            with self.io_lock(inode):
+                if size > inode.seek(0, os.SEEK_END):
+                    inode.write(b"\0" * (size - inode.tell()))
+                else:
+                    inode.seek(size)
+                    inode.truncate()
 
+    @timed("open")
     def open(self, inode):
         with self.lock:
             # 8<-----------------------------------------
             # on_open hook
-            hook_data = None
-            if inode.on_open is not None:
-                try:
-                    hook_data = inode.on_open(inode)
-                except Exception:
-                    logging.error('on_open hook failed: %s\n%s' %
-                                  (inode, traceback.format_exc()))
-                if hook_data is None:
-                    return
+            (proceed, hook_data) = self.hook(inode, "on_open")
+            if not proceed:
+                return
             # 8<-----------------------------------------
             self.sync(inode)
-            inode.open(hook_data)
+            with self.io_lock(inode):
+                inode.open(hook_data)
 
+    @timed("sync")
     def sync(self, inode):
+        # nothing to do, so no need to lock
+        if inode.static:
+            return
         with self.lock:
             if not inode.writelock:
                 # 8<-------------------------------------
                 # on_sync hook
-                hook_data = None
-                if inode.on_sync is not None:
-                    try:
-                        hook_data = inode.on_sync(inode)
-                    except Exception:
-                        logging.error('on_sync hook failed: %s\n%s' %
-                                      (inode, traceback.format_exc()))
-                    if hook_data is None:
-                        return
+                (proceed, hook_data) = self.hook(inode, "on_sync")
+                if not proceed:
+                    return
                 # 8<-------------------------------------
-                inode.sync(hook_data)
+                with self.io_lock(inode):
+                    inode.sync(hook_data)
 
+    @timed("commit")
     def commit(self, inode):
         with self.lock:
             if inode.writelock:
                 inode.writelock = False
                 # 8<-------------------------------------
                 # on_commit hook
-                hook_data = None
-                if inode.on_commit is not None:
-                    try:
-                        hook_data = inode.on_commit(inode)
-                    except Exception:
-                        logging.error('on_commit hook failed: %s\n%s' %
-                                      (inode, traceback.format_exc()))
-                    if hook_data is None:
-                        return
+                (proceed, hook_data) = self.hook(inode, "on_commit")
+                if not proceed:
+                    return
                 # 8<-------------------------------------
-                inode.commit(hook_data)
+                with self.io_lock(inode):
+                    inode.commit(hook_data)
 
+    @timed("write")
     def write(self, inode, data, offset=0):
         with self.lock:
             inode.writelock = True
-            inode.seek(offset, os.SEEK_SET)
-            inode.write(data)
+            with self.io_lock(inode):
+                inode.seek(offset, os.SEEK_SET)
+                inode.write(data)
         return len(data)
 
+    @timed("read")
     def read(self, inode, size, offset=0):
-        with self.lock:
-            if offset == 0:
+        """
+        Read the inode buffer, the sync is done at offset 0
+        only; so reads at other offsets take only the inode
+        I/O lock, see io_lock(). Reads at offset 0 of inodes,
+        that are not static, sync under the storage lock, so
+        those are serialized.
+        """
+        if offset == 0:
+            with self.lock:
+                if inode.blocking:
+                    self.wait(inode)
                 self.sync(inode)
+        with self.io_lock(inode):
             inode.seek(offset, os.SEEK_SET)
-            data = inode.read(size)
-        return data
+            return inode.read(size)
 
+    def wait(self, inode):
+        """
+        Block until the inode is ready to be read, see
+        Inode.pending(). The storage lock is released while
+        waiting.
+        """
+        with self.lock:
+            while True:
+                delay = inode.pending()
+                if delay <= 0:
+                    return
+                self.ready.wait(delay)
+
+    def wakeup(self):
+        """
+        Blocking inodes may be ready: wake up threads in wait()
+        and run the ``waiters`` callbacks. Front-ends, that can
+        not block, like 9p, defer requests with the callbacks.
+        """
+        with self.lock:
+            self.ready.notify_all()
+            for waiter in list(self.waiters):
+                try:
+                    if not waiter():
+                        self.waiters.remove(waiter)
+                except Exception:
+                    self.waiters.remove(waiter)
+                    logging.error('waiter failed: %s' %
+                                  (traceback.format_exc()))
+
+    @timed("destroy")
     def destroy(self, inode):
         with self.lock:
             # 8<-----------------------------------------
             # on_destroy hook
-            hook_data = None
-            if inode.on_destroy is not None:
-                try:
-                    hook_data = inode.on_destroy(inode)
-                except Exception:
-                    logging.error('on_destroy hook failed: %s\n%s' %
-                                  (inode, traceback.format_exc()))
-                if hook_data is None:
-                    return
+            (proceed, hook_data) = self.hook(inode, "on_destroy")
+            if not proceed:
+                return
             # 8<-----------------------------------------
             for i, k in list(inode.children.items()):
                 if i not in inode.special_names:
@@ -393,6 +793,7 @@ class Storage(object):
             inode.parent.remove(inode)
             self.unregister(inode)
 
+    @timed("remove")
     def remove(self, inode):
         with self.lock:
             inode.destroy()